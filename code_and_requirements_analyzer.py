@@ -6,14 +6,23 @@ import re
 import html
 import random
 import asyncio
+import sqlite3
+import uuid
+import hashlib
+import aiohttp
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit, parse_qs, unquote_plus
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_gigachat.chat_models import GigaChat
 from _config import TOKEN, credentials
 
@@ -27,9 +36,699 @@ gigachat_model = GigaChat(
     model="GigaChat-2-Max"
 )
 
-# Глобальные переменные
-thread_id = random.randint(1, 1000)
-config_ = {"configurable": {"thread_id": f'{thread_id}'}
+# Параметры хранилища сессий
+SESSIONS_DB = os.getenv("ANALYZER_SESSIONS_DB", "analyzer_sessions.db")
+SESSION_CACHE_SIZE = 1000          # Сколько сессий держим в памяти
+SESSION_TTL = 30 * 60              # Через сколько секунд простоя сессия выгружается из памяти
+SESSION_RETENTION = 30 * 24 * 3600 # Через сколько секунд простоя сессия удаляется из базы
+
+class SessionStore:
+    """Сопоставляет каждому чату Telegram собственный поток графа.
+
+    Активные сессии лежат в LRU-кеше с TTL, все сессии - в SQLite.
+    Сессия подгружается из базы только при первом обращении после
+    рестарта или вытеснения, поэтому старт бота не зависит от числа
+    пользователей. Состояние самого графа хранит его checkpointer:
+    граф нужно компилировать с AsyncSqliteSaver на файле SESSIONS_DB,
+    тогда после рестарта чат продолжит свой прежний thread_id.
+    """
+
+    def __init__(self, db_path, max_size=SESSION_CACHE_SIZE, ttl=SESSION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # chat_id -> (thread_id, last_seen)
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, thread_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get_config(self, chat_id):
+        """Конфигурация графа для чата"""
+        return {"configurable": {"thread_id": self.get_thread_id(chat_id)}}
+
+    def get_thread_id(self, chat_id):
+        now = time.time()
+        self._evict_expired(now)
+
+        entry = self._cache.pop(chat_id, None)
+        if entry is not None:
+            # Попадание в кеш обходится без записи в базу: время активности
+            # сохранится, когда сессия будет выгружена из памяти
+            thread_id = entry[0]
+            self._cache[chat_id] = (thread_id, now)
+            return thread_id
+
+        row = self._db.execute(
+            "SELECT thread_id FROM sessions WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        thread_id = row[0] if row else uuid.uuid4().hex
+        self._remember(chat_id, thread_id, now)
+        return thread_id
+
+    def reset(self, chat_id):
+        """Начинает для чата новый поток графа"""
+        thread_id = uuid.uuid4().hex
+        self._cache.pop(chat_id, None)
+        self._remember(chat_id, thread_id, time.time())
+        return thread_id
+
+    def purge(self, max_age=SESSION_RETENTION):
+        """Удаляет из базы давно неактивные сессии"""
+        self._touch(self._active_entries())
+        self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age,))
+        self._db.commit()
+
+    def close(self):
+        self._touch(self._active_entries())
+        self._db.close()
+
+    def _remember(self, chat_id, thread_id, now):
+        self._cache[chat_id] = (thread_id, now)
+        self._db.execute(
+            "INSERT INTO sessions (chat_id, thread_id, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET thread_id = excluded.thread_id, updated_at = excluded.updated_at",
+            (chat_id, thread_id, now)
+        )
+        self._db.commit()
+        evicted = []
+        while len(self._cache) > self.max_size:
+            chat_id, (_, last_seen) = self._cache.popitem(last=False)
+            evicted.append((chat_id, last_seen))
+        self._touch(evicted)
+
+    def _active_entries(self):
+        return [(chat_id, last_seen) for chat_id, (_, last_seen) in self._cache.items()]
+
+    def _touch(self, entries):
+        """Одним запросом сохраняет время последней активности сессий"""
+        if not entries:
+            return
+        self._db.executemany(
+            "UPDATE sessions SET updated_at = MAX(updated_at, ?) WHERE chat_id = ?",
+            [(last_seen, chat_id) for chat_id, last_seen in entries]
+        )
+        self._db.commit()
+
+    def _evict_expired(self, now):
+        # Самые старые записи в начале словаря, поэтому достаточно смотреть с головы
+        evicted = []
+        while self._cache:
+            chat_id, (_, last_seen) = next(iter(self._cache.items()))
+            if now - last_seen < self.ttl:
+                break
+            del self._cache[chat_id]
+            evicted.append((chat_id, last_seen))
+        self._touch(evicted)
+
+sessions = SessionStore(SESSIONS_DB)
+
+# Параметры потоковой выдачи ответа
+EDIT_INTERVAL = 1.5         # Не чаще одного редактирования сообщения за столько секунд
+TELEGRAM_MESSAGE_LIMIT = 4096
+MAX_STREAM_MESSAGES = 3     # Сколько сообщений занимает ответ в чате
+RESULT_HEADER = "📋 <b>Результаты анализа:</b>\n\n"
+TRUNCATED_NOTE = "\n\n<i>…продолжение будет в файле</i>"
+CURSOR = " ▌"
+# Сколько символов экранированного текста помещаем в одно сообщение:
+# остаток лимита Telegram после заголовка и приписки о продолжении
+MESSAGE_LIMIT = TELEGRAM_MESSAGE_LIMIT - len(RESULT_HEADER) - max(len(TRUNCATED_NOTE), len(CURSOR))
+
+def _escaped_prefix(text, limit):
+    """Длина самого длинного префикса text, который после html.escape не длиннее limit"""
+    size = 0
+    for index, char in enumerate(text):
+        size += len(html.escape(char))
+        if size > limit:
+            return index
+    return len(text)
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """Делит текст на части, которые после html.escape не длиннее limit,
+    по возможности по границам абзацев"""
+    parts = []
+    while len(html.escape(text)) > limit:
+        hard = max(1, _escaped_prefix(text, limit))
+        cut = text.rfind("\n\n", 0, hard)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, hard)
+        if cut <= 0:
+            cut = hard
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+class ProgressiveReply:
+    """Показывает ответ в чате по мере генерации.
+
+    Токены копятся в буфере и выводятся не чаще раза в EDIT_INTERVAL
+    секунд через edit_message_text. Длинный текст раскладывается на
+    несколько сообщений по границам абзацев; уже заполненные сообщения
+    больше не редактируются.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.text = ""
+        self.truncated = False  # Текст не поместился в MAX_STREAM_MESSAGES сообщений
+        self._sent = []       # Отправленные сообщения
+        self._rendered = []   # Текст, который сейчас показан в каждом из них
+        self._last_flush = 0.0
+
+    async def feed(self, chunk):
+        self.text += chunk
+        if time.monotonic() - self._last_flush >= EDIT_INTERVAL:
+            await self.flush(cursor=True)
+
+    async def finish(self, final_text=None):
+        """Выводит окончательный текст, а не поместившийся в чат отчет прикладывает файлом"""
+        if final_text is not None:
+            self.text = final_text
+        await self.flush(cursor=False)
+
+        if self.truncated:
+            await self.message.answer_document(
+                document=BufferedInputFile(self.text.encode("utf-8"), filename="analysis.txt"),
+                caption="📄 Полные результаты анализа"
+            )
+
+    async def flush(self, cursor):
+        self._last_flush = time.monotonic()
+        if not self.text.strip():
+            return
+
+        parts = split_text(self.text)
+        truncated = self.truncated = len(parts) > MAX_STREAM_MESSAGES
+        parts = parts[:MAX_STREAM_MESSAGES]
+
+        for index, part in enumerate(parts):
+            rendered = html.escape(part)
+            if index == 0:
+                rendered = RESULT_HEADER + rendered
+            if index == len(parts) - 1:
+                if truncated:
+                    rendered += TRUNCATED_NOTE
+                elif cursor:
+                    rendered += CURSOR
+            if not await self._show(index, rendered, wait=not cursor):
+                return
+
+        # Если текст сократился, лишние сообщения удаляем
+        while len(self._sent) > len(parts):
+            await self._sent.pop().delete()
+            self._rendered.pop()
+
+    async def _show(self, index, rendered, wait):
+        if index < len(self._sent) and self._rendered[index] == rendered:
+            return True
+        while True:
+            try:
+                if index < len(self._sent):
+                    await self._sent[index].edit_text(rendered)
+                    self._rendered[index] = rendered
+                else:
+                    self._sent.append(await self.message.answer(rendered))
+                    self._rendered.append(rendered)
+                return True
+            except TelegramRetryAfter as e:
+                if not wait:
+                    # Промежуточное обновление пропускаем, следующее покажет актуальный текст
+                    self._last_flush = time.monotonic() + e.retry_after
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+                self._rendered[index] = rendered
+                return True
+
+# Подтверждение начала обработки: "local" - шаблоны без обращения к модели,
+# "llm" - короткий ответ GigaChat, который генерируется параллельно с анализом
+ACK_MODE = os.getenv("ANALYZER_ACK_MODE", "local")
+
+INTENT_PATTERNS = [
+    ("compliance", re.compile(r"соответств|соответствует|по требованиям|требованиям\s+код|реализ\w+ ли", re.I)),
+    ("code", re.compile(r"```|\bdef\s+\w+\(|\bclass\s+\w+|\bimport\s+\w+|\bfunction\s+\w+|\bpublic\s+\w+|[;{}]\s*$|\bкод\w*", re.I | re.M)),
+    ("requirements", re.compile(r"требовани|\bтз\b|user story|пользовател\w+ истори|должн[аыо]?\b|confluence", re.I)),
+    ("question", re.compile(r"\?\s*$|^\s*(как|что|почему|зачем|какие|какой|можно ли)\b", re.I | re.M)),
+]
+
+ACK_TEMPLATES = {
+    "compliance": [
+        "Сверяю код с требованиями, это займет немного времени.",
+        "Начал проверку соответствия кода требованиям.",
+    ],
+    "code": [
+        "Начал анализ кода: смотрю на качество и возможные ошибки.",
+        "Код получен, приступаю к проверке.",
+    ],
+    "requirements": [
+        "Изучаю требования: ищу противоречия и двусмысленности.",
+        "Требования получены, начинаю анализ.",
+    ],
+    "question": [
+        "Готовлю ответ на ваш вопрос.",
+        "Вопрос принят, разбираюсь.",
+    ],
+    "general": [
+        "Запрос принят, начинаю обработку.",
+    ],
+}
+
+def detect_intent(text):
+    """Определяет тип запроса по ключевым словам, без обращения к модели"""
+    for intent, pattern in INTENT_PATTERNS:
+        if pattern.search(text or ""):
+            return intent
+    return "general"
+
+def local_acknowledgement(text):
+    return random.choice(ACK_TEMPLATES[detect_intent(text)])
+
+async def send_llm_acknowledgement(message: Message, user_text):
+    """Короткий ответ GigaChat о начале обработки (режим ACK_MODE=llm)"""
+    try:
+        quick_response = await gigachat_model.ainvoke([
+            SystemMessage(content="Дайте краткий ответ, что начали обработку запроса"),
+            HumanMessage(content=user_text)
+        ])
+        await message.answer(f"🔎 <i>{html.escape(quick_response.content)}</i>")
+    except Exception as e:
+        logging.warning(f"Acknowledgement failed: {str(e)}")
+        await message.answer(f"🔎 <i>{local_acknowledgement(user_text)}</i>")
+
+# Работа с Confluence
+CONFLUENCE_TOKEN = os.getenv("CONFLUENCE_TOKEN")
+CONFLUENCE_URL = os.getenv("CONFLUENCE_URL")   # Адрес Confluence, например https://wiki.example.ru
+CONFLUENCE_CONCURRENCY = 8   # Сколько страниц загружаем одновременно
+SECTION_CONCURRENCY = 4      # Сколько измененных разделов анализируем одновременно
+MIN_SECTION_LENGTH = 40      # Более короткие разделы не отправляем в модель
+
+URL_RE = re.compile(r"https?://[^\s<>\"']+")
+PAGE_PATH_RE = re.compile(r"^(?P<base>.*?)/(?:pages/viewpage\.action|spaces/[^/]+/pages/(?P<id>\d+)|display/(?P<space>[^/]+)/(?P<title>[^/?#]+))")
+HEADING_RE = re.compile(r"<h([1-3])[^>]*>(.*?)</h\1>", re.I | re.S)
+TAG_RE = re.compile(r"<[^>]+>")
+
+def find_confluence_links(text, base_url=CONFLUENCE_URL):
+    """Ссылки на страницы настроенного Confluence в тексте запроса.
+
+    Ссылки на другие хосты не загружаются: токен Confluence уходит только туда,
+    куда его разрешили отправлять.
+    """
+    if not base_url:
+        return []
+    host = urlsplit(base_url).netloc.lower()
+    links = []
+    for url in URL_RE.findall(text or ""):
+        url = url.rstrip(".,;)")
+        parts = urlsplit(url)
+        if parts.netloc.lower() == host and PAGE_PATH_RE.match(parts.path):
+            links.append(url)
+    return links
+
+def html_to_text(markup):
+    text = TAG_RE.sub(" ", re.sub(r"</(p|li|tr|h\d)>|<br\s*/?>", "\n", markup, flags=re.I))
+    return re.sub(r"[ \t]+", " ", html.unescape(text)).strip()
+
+def split_sections(markup):
+    """Делит страницу на разделы по заголовкам h1-h3.
+
+    Ключ раздела - путь из заголовков, поэтому он не меняется при правках
+    текста внутри раздела или в соседних разделах.
+    """
+    sections = []
+    path = []
+    seen = Counter()
+    matches = list(HEADING_RE.finditer(markup))
+    bounds = [(None, 0, matches[0].start() if matches else len(markup))]
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(markup)
+        bounds.append((match, match.end(), end))
+
+    for match, start, end in bounds:
+        if match is not None:
+            level = int(match.group(1))
+            path = path[:level - 1] + [html_to_text(match.group(2)) or "Без названия"]
+        key = " / ".join(path) or "Введение"
+        seen[key] += 1
+        if seen[key] > 1:
+            key = f"{key} #{seen[key]}"
+        text = html_to_text(markup[start:end])
+        digest = hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+        sections.append({"key": key, "text": text, "hash": digest})
+    return sections
+
+class ConfluenceClient:
+    """Загружает страницы Confluence через общий пул соединений.
+
+    Адрес REST API берется из самой ссылки, поэтому клиент одинаково
+    работает с боевым Confluence и с локальной заглушкой.
+    """
+
+    def __init__(self, token=CONFLUENCE_TOKEN, concurrency=CONFLUENCE_CONCURRENCY):
+        self.token = token
+        self.concurrency = concurrency
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            headers = {"Accept": "application/json"}
+            if self.token:
+                headers["Authorization"] = f"Bearer {self.token}"
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+        return self._session
+
+    async def fetch_page(self, url):
+        parts = urlsplit(url)
+        match = PAGE_PATH_RE.match(parts.path)
+        base = f"{parts.scheme}://{parts.netloc}{match.group('base')}/rest/api/content"
+        params = {"expand": "body.storage,version"}
+        page_id = match.group("id") or parse_qs(parts.query).get("pageId", [None])[0]
+
+        session = self._get_session()
+        if page_id:
+            async with session.get(f"{base}/{page_id}", params=params) as response:
+                response.raise_for_status()
+                data = await response.json()
+        else:
+            params.update(spaceKey=match.group("space"), title=unquote_plus(match.group("title")))
+            async with session.get(base, params=params) as response:
+                response.raise_for_status()
+                results = (await response.json()).get("results", [])
+            if not results:
+                raise LookupError(f"Страница не найдена: {url}")
+            data = results[0]
+
+        return {
+            "id": str(data["id"]),
+            "title": data.get("title", url),
+            "version": data.get("version", {}).get("number"),
+            "body": data["body"]["storage"]["value"],
+        }
+
+    async def fetch_pages(self, urls):
+        """Загружает страницы параллельно; для неудачных ссылок возвращает исключение"""
+        return await asyncio.gather(*(self.fetch_page(url) for url in urls), return_exceptions=True)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+class SectionStore:
+    """Хеши и результаты анализа разделов страниц Confluence в SQLite"""
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS confluence_sections ("
+            "page_id TEXT NOT NULL, section_key TEXT NOT NULL, content_hash TEXT NOT NULL, "
+            "findings TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (page_id, section_key))"
+        )
+        self._db.commit()
+
+    def load(self, page_id):
+        rows = self._db.execute(
+            "SELECT section_key, content_hash, findings FROM confluence_sections WHERE page_id = ?", (page_id,)
+        ).fetchall()
+        return {key: (content_hash, findings) for key, content_hash, findings in rows}
+
+    def save(self, page_id, key, content_hash, findings):
+        self._db.execute(
+            "INSERT OR REPLACE INTO confluence_sections VALUES (?, ?, ?, ?, ?)",
+            (page_id, key, content_hash, findings, time.time())
+        )
+        self._db.commit()
+
+    def remove(self, page_id, keys):
+        self._db.executemany(
+            "DELETE FROM confluence_sections WHERE page_id = ? AND section_key = ?",
+            [(page_id, key) for key in keys]
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+confluence = ConfluenceClient()
+section_store = SectionStore(SESSIONS_DB)
+
+async def analyze_section(page, section, instructions, semaphore):
+    """Анализирует один раздел страницы отдельным запросом к модели, без истории диалога"""
+    prompt = [
+        SystemMessage(content=(
+            "Ты анализируешь раздел требований из Confluence. "
+            "Найди логические ошибки, двусмысленные формулировки и противоречия."
+        )),
+        HumanMessage(content=(
+            f"Раздел «{section['key']}» страницы «{page['title']}».\n"
+            f"{instructions}\n\n{section['text']}"
+        ))
+    ]
+    async with semaphore:
+        response = await gigachat_model.ainvoke(prompt)
+    return response.content
+
+async def analyze_confluence_pages(links, instructions):
+    """Анализирует страницы Confluence, отправляя в граф только измененные разделы"""
+    semaphore = asyncio.Semaphore(SECTION_CONCURRENCY)
+    reports = []
+
+    for url, page in zip(links, await confluence.fetch_pages(links)):
+        if isinstance(page, Exception):
+            logging.warning(f"Confluence fetch failed for {url}: {page}")
+            reports.append(f"⚠️ Не удалось загрузить страницу {url}")
+            continue
+
+        sections = split_sections(page["body"])
+        known = section_store.load(page["id"])
+        changed = [
+            s for s in sections
+            if len(s["text"]) >= MIN_SECTION_LENGTH and known.get(s["key"], (None,))[0] != s["hash"]
+        ]
+        # Раздел, сократившийся до пустяка, больше не анализируется - прежние замечания к нему устарели
+        shrunk = {
+            s["key"] for s in sections
+            if len(s["text"]) < MIN_SECTION_LENGTH and s["key"] in known and known[s["key"]][0] != s["hash"]
+        }
+        section_store.remove(page["id"], shrunk)
+        for key in shrunk:
+            del known[key]
+        findings = await asyncio.gather(
+            *(analyze_section(page, s, instructions, semaphore) for s in changed), return_exceptions=True
+        )
+        # Неудачный раздел не сохраняем, чтобы при следующем запуске он снова попал в измененные
+        failed = {}
+        for section, result in zip(changed, findings):
+            if isinstance(result, Exception):
+                logging.error(f"Analysis of section {section['key']} failed: {str(result)}")
+                failed[section["key"]] = str(result)
+                continue
+            section_store.save(page["id"], section["key"], section["hash"], result)
+            known[section["key"]] = (section["hash"], result)
+
+        removed = set(known) - {s["key"] for s in sections}
+        section_store.remove(page["id"], removed)
+
+        changed_keys = {s["key"] for s in changed}
+        lines = [f"📄 {page['title']} (версия {page['version']}): изменено разделов {len(changed)} из {len(sections)}"]
+        for section in sections:
+            if section["key"] in failed:
+                lines.append(f"\n⚠️ {section['key']}\nНе удалось проанализировать раздел: {failed[section['key']]}")
+                continue
+            if section["key"] not in known:
+                continue
+            mark = "✏️" if section["key"] in changed_keys else "✅"
+            lines.append(f"\n{mark} {section['key']}\n{known[section['key']][1]}")
+        if removed:
+            lines.append("\n🗑 Удаленные разделы: " + ", ".join(sorted(removed)))
+        reports.append("\n".join(lines))
+
+    return "\n\n".join(reports)
+
+# Ревью больших отправок по частям
+UNIT_TOKEN_BUDGET = 6000         # Максимальный размер одной части кода в токенах
+INFLIGHT_TOKEN_BUDGET = 24000    # Сколько токенов может одновременно находиться в запросах к модели
+REVIEW_THRESHOLD_TOKENS = 8000   # С какого размера отправка проверяется по частям
+
+FENCE_RE = re.compile(r"```[^\n]*\n(.*?)```", re.S)
+FILE_NAME_RE = re.compile(r"^[\w./\\-]*\w\.\w{1,6}$")
+FILE_MENTION_RE = re.compile(r"([\w./\\-]+\.(\w{1,6}))\W*$")
+CODE_EXTENSIONS = {
+    "py", "js", "jsx", "ts", "tsx", "java", "kt", "kts", "go", "rs", "c", "h", "cc", "cpp", "hpp",
+    "cs", "rb", "php", "swift", "scala", "sql", "sh", "bash", "ps1", "json", "yaml", "yml", "xml",
+    "toml", "ini", "cfg", "html", "css", "scss", "vue", "proto", "gradle", "md",
+}
+UNIT_START_RE = re.compile(r"^(?:async\s+def|def|class|function|func|fn|public|private|protected|interface|struct)\b[^\n]*", re.M)
+UNIT_NAME_RE = re.compile(r"(?:def|class|function|func|fn|interface|struct)\s+(\w+)|(\w+)\s*\(")
+REQUIREMENT_ITEM_RE = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s+", re.M)
+REQUIREMENT_REF_RE = re.compile(r"\b[ТT](\d+)\b")
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов: для смеси кода и русского текста около 3 символов на токен"""
+    return len(text) // 3 + 1
+
+def file_name_from_line(line):
+    """Имя файла из строки перед блоком кода: вся строка целиком - путь к файлу
+    (`src/app.py`, **main.go:**) или в конце строки упомянут файл с расширением кода"""
+    bare = line.strip().strip("`*#_:").strip()
+    if FILE_NAME_RE.match(bare):
+        return bare
+    mention = FILE_MENTION_RE.search(line)
+    if mention and mention.group(2).lower() in CODE_EXTENSIONS:
+        return mention.group(1)
+    return None
+
+def parse_submission(text):
+    """Отделяет требования от кода. Код - это блоки ``` ```, имя файла берется из строки перед блоком"""
+    files = []
+    requirements = []
+    position = 0
+    for i, match in enumerate(FENCE_RE.finditer(text)):
+        before = text[position:match.start()].rstrip()
+        head, _, preceding = before.rpartition("\n")
+        name = file_name_from_line(preceding)
+        # Строка с именем файла относится к коду, а не к требованиям
+        requirements.append(head if name else before)
+        files.append((name or f"file{i + 1}", match.group(1)))
+        position = match.end()
+    requirements.append(text[position:])
+    return "\n".join(requirements).strip(), files
+
+def number_requirements(requirements):
+    """Нумерует требования как Т1, Т2, ... для перекрестных ссылок"""
+    if REQUIREMENT_ITEM_RE.search(requirements):
+        items = REQUIREMENT_ITEM_RE.split(requirements)[1:]
+    else:
+        items = re.split(r"\n\s*\n", requirements)
+    items = [" ".join(item.split()) for item in items if item.strip()]
+    return [(f"Т{i}", item) for i, item in enumerate(items, start=1)]
+
+def split_units(file_name, code, budget=UNIT_TOKEN_BUDGET):
+    """Делит файл на части по функциям и классам верхнего уровня, укладывая их в бюджет токенов"""
+    starts = [m.start() for m in UNIT_START_RE.finditer(code)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    pieces = [code[a:b] for a, b in zip(starts, starts[1:] + [len(code)]) if code[a:b].strip()]
+
+    # Слишком большие куски режем по строкам
+    sized = []
+    for piece in pieces:
+        while estimate_tokens(piece) > budget:
+            cut = piece.rfind("\n", 0, budget * 3) + 1 or budget * 3
+            sized.append(piece[:cut])
+            piece = piece[cut:]
+        sized.append(piece)
+
+    # Соседние мелкие куски объединяем
+    units = []
+    for piece in sized:
+        if units and estimate_tokens(units[-1] + piece) <= budget:
+            units[-1] += piece
+        else:
+            units.append(piece)
+
+    named = []
+    for i, unit in enumerate(units, start=1):
+        match = UNIT_START_RE.search(unit)
+        name = UNIT_NAME_RE.search(match.group(0)) if match else None
+        label = (name.group(1) or name.group(2)) if name else f"часть {i}"
+        named.append((f"{file_name}:{label}", unit))
+    return named
+
+class TokenBudget:
+    """Ограничивает суммарный размер одновременных запросов к модели"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, tokens):
+        async with self._condition:
+            # Запрос больше всего бюджета пропускаем, когда остальные завершились
+            await self._condition.wait_for(
+                lambda: self.in_flight == 0 or self.in_flight + tokens <= self.capacity
+            )
+            self.in_flight += tokens
+
+    async def release(self, tokens):
+        async with self._condition:
+            self.in_flight -= tokens
+            self._condition.notify_all()
+
+def needs_split_review(text):
+    _, files = parse_submission(text)
+    return len(files) > 1 or (files and estimate_tokens(text) > REVIEW_THRESHOLD_TOKENS)
+
+async def review_unit(unit_name, code, requirements_block, budget):
+    """Проверяет одну часть кода на соответствие требованиям"""
+    prompt = [
+        SystemMessage(content=(
+            "Ты проверяешь фрагмент кода на соответствие требованиям и на качество. "
+            "Ссылайся на требования по их номерам, например Т3. "
+            "Если замечаний нет, ответь «Замечаний нет»."
+        )),
+        HumanMessage(content=f"Требования:\n{requirements_block}\n\nФрагмент {unit_name}:\n```\n{code}\n```")
+    ]
+    tokens = estimate_tokens(requirements_block) + estimate_tokens(code)
+    await budget.acquire(tokens)
+    try:
+        response = await gigachat_model.ainvoke(prompt)
+        return response.content
+    except Exception as e:
+        logging.error(f"Review of {unit_name} failed: {str(e)}")
+        return f"⚠️ Не удалось проверить фрагмент: {str(e)}"
+    finally:
+        await budget.release(tokens)
+
+async def review_submission(text):
+    """Map-reduce ревью: параллельная проверка частей кода и сводный отчет"""
+    requirements, files = parse_submission(text)
+    numbered = number_requirements(requirements)
+    requirements_block = "\n".join(f"{label}. {item}" for label, item in numbered) or "Требования не указаны"
+
+    units = [unit for name, code in files for unit in split_units(name, code)]
+    budget = TokenBudget(INFLIGHT_TOKEN_BUDGET)
+    findings = await asyncio.gather(
+        *(review_unit(name, code, requirements_block, budget) for name, code in units)
+    )
+
+    # Сводим замечания и строим перекрестные ссылки на требования
+    references = {label: [] for label, _ in numbered}
+    lines = [f"Проверено файлов: {len(files)}, фрагментов: {len(units)}"]
+    for (name, _), result in zip(units, findings):
+        lines.append(f"\n🔹 {name}\n{result}")
+        for number in sorted(set(REQUIREMENT_REF_RE.findall(result)), key=int):
+            references.setdefault(f"Т{number}", []).append(name)
+
+    if numbered:
+        lines.append("\n📌 Требования и фрагменты, где они упомянуты:")
+        for label, item in numbered:
+            places = ", ".join(references[label]) or "не упомянуто ни в одном фрагменте"
+            lines.append(f"{label}. {item[:80]} — {places}")
+    return "\n".join(lines)
+
+# Параметры очереди анализа
+MAX_WORKERS = 4          # Сколько анализов выполняется одновременно
+MAX_QUEUE_SIZE = 50      # Сколько запросов может ждать в очереди
+PER_CHAT_LIMIT = 1       # Сколько запросов одного чата может быть в работе
+
+@dataclass(eq=False)
+class AnalysisJob:
+    message: Message
+    text: str
+    created_at: float = field(default_factory=time.monotonic)
+
+job_queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+pending_jobs = []        # Задания в порядке очереди, для отчета о позиции
+chat_jobs = Counter()    # chat_id -> число заданий в очереди и в работе
+active_jobs = 0
 
 # Инициализация бота и диспетчера
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -122,52 +821,121 @@ async def start_session(callback: CallbackQuery, state: FSMContext):
 
 @dp.callback_query(lambda c: c.data == "stop_session")
 async def stop_session(callback: CallbackQuery, state: FSMContext):
-    global config_
-    thread_id = random.randint(1, 1000)
-    config_ = {"configurable": {"thread_id": f'{thread_id}'}}
-    
+    sessions.reset(callback.message.chat.id)
+
     await callback.message.answer("🛑 <b>Сессия завершена.</b> Данные очищены.\n\nДля нового анализа нажмите /start")
     await state.clear()
     await callback.answer()
 
 @dp.message(BotState.active_session)
 async def process_message(message: Message):
-    try:
-        user_text = message.text
-        
-        # Сначала получаем быстрый ответ от GigaChat
-        quick_response = gigachat_model.invoke([
-            SystemMessage(content="Дайте краткий ответ, что начали обработку запроса"),
-            HumanMessage(content=user_text)
-        ])
-        
-        await message.answer(f"🔎 <i>{quick_response.content}</i>")
-        
-        # Затем обрабатываем запрос через граф
-        full_response = graph.invoke({"messages": user_text}, config=config_)
-        response_content = full_response["messages"][-1].content
-        
-        # Если ответ слишком длинный, отправляем файлом
-        if len(response_content) > 4000:
-            with open('response.txt', 'w', encoding="utf-8") as f:
-                f.write(response_content)
-            await message.answer_document(
-                document=FSInputFile('response.txt'),
-                caption="📄 Вот результаты анализа:"
-            )
+    chat_id = message.chat.id
+
+    if chat_jobs[chat_id] >= PER_CHAT_LIMIT:
+        await message.answer("⏳ Предыдущий запрос еще обрабатывается. Дождитесь результата.")
+        return
+
+    if job_queue.full():
+        await message.answer("🚦 Сейчас слишком много запросов. Попробуйте через пару минут.")
+        return
+
+    job = AnalysisJob(message=message, text=message.text)
+    chat_jobs[chat_id] += 1
+    pending_jobs.append(job)
+    job_queue.put_nowait(job)
+
+    # Если все обработчики заняты, сообщаем позицию в очереди
+    if active_jobs >= MAX_WORKERS:
+        position = pending_jobs.index(job) + 1
+        await message.answer(f"🕒 Запрос поставлен в очередь. Ваша позиция: <b>{position}</b>")
+
+async def run_analysis(job: AnalysisJob):
+    message = job.message
+    user_text = job.text
+
+    # Подтверждаем начало обработки, не задерживая сам анализ
+    ack_task = None
+    if ACK_MODE == "llm":
+        ack_task = asyncio.create_task(send_llm_acknowledgement(message, user_text))
+    else:
+        await message.answer(f"🔎 <i>{local_acknowledgement(user_text)}</i>")
+
+    reply = ProgressiveReply(message)
+
+    # Страницы Confluence анализируем по разделам, повторно - только измененные
+    links = find_confluence_links(user_text)
+    if links:
+        instructions = user_text
+        for link in links:
+            instructions = instructions.replace(link, "")
+        await reply.finish(await analyze_confluence_pages(links, instructions.strip()))
+        return
+
+    # Несколько файлов или большой объем кода проверяем по частям параллельно
+    if needs_split_review(user_text):
+        await reply.finish(await review_submission(user_text))
+        return
+
+    # Параллельно обрабатываем запрос через граф, показывая ответ по мере генерации
+    config = sessions.get_config(message.chat.id)
+    final_state = None
+    async for mode, payload in graph.astream(
+        {"messages": user_text}, config=config, stream_mode=["messages", "values"]
+    ):
+        if mode == "messages":
+            chunk, _ = payload
+            if isinstance(chunk.content, str) and chunk.content:
+                # Подтверждение, не успевшее до первых токенов ответа, уже не нужно
+                if ack_task and not ack_task.done():
+                    ack_task.cancel()
+                await reply.feed(chunk.content)
         else:
-            await message.answer(f"📋 <b>Результаты анализа:</b>\n\n{response_content}")
-            
-    except Exception as e:
-        logging.error(f"Error processing message: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка при обработке запроса. Попробуйте снова или завершите сессию /stop")
+            final_state = payload
+
+    # Итоговое сообщение графа точнее склейки токенов всех его узлов
+    final_text = final_state["messages"][-1].content if final_state else None
+    await reply.finish(final_text)
+
+async def analysis_worker():
+    """Берет задания из общей очереди и выполняет их по одному"""
+    global active_jobs
+    while True:
+        job = await job_queue.get()
+        pending_jobs.remove(job)
+        active_jobs += 1
+        chat_id = job.message.chat.id
+        try:
+            logging.info(f"Chat {chat_id}: job started after {time.monotonic() - job.created_at:.1f}s in queue")
+            await run_analysis(job)
+        except Exception as e:
+            logging.error(f"Error processing message: {str(e)}")
+            # Сообщение об ошибке тоже может не уйти (flood control, сеть) - воркер при этом должен выжить
+            try:
+                await job.message.answer("⚠️ Произошла ошибка при обработке запроса. Попробуйте снова или завершите сессию /stop")
+            except Exception as reply_error:
+                logging.error(f"Chat {chat_id}: failed to report error: {str(reply_error)}")
+        finally:
+            active_jobs -= 1
+            chat_jobs[chat_id] -= 1
+            if chat_jobs[chat_id] <= 0:
+                del chat_jobs[chat_id]
+            job_queue.task_done()
 
 async def main():
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
-    await dp.start_polling(bot, skip_updates=True)
+    sessions.purge()
+    workers = [asyncio.create_task(analysis_worker()) for _ in range(MAX_WORKERS)]
+    try:
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await confluence.close()
+        section_store.close()
+        sessions.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,37 +1,293 @@
-// Настройка подключения
-import { configureEnv } from 'dotenv';
-import { DocumentManager } from 'gigachat';
-import { SecureConnection } from 'node:https';
-import { resolvePath } from 'node:path';
-import { readBinaryData } from 'node:fs';
-
-const connectionSettings = new SecureConnection({
-  verifyCertificate: false,
-});
-
-configureEnv();
-const docManager = new DocumentManager({
-  operationTimeout: 600,
-  processingModel: 'GigaChat-Pro',
-  secureChannel: connectionSettings,
-});
-
-// Добавление нового документа
-const documentLocation = resolvePath('./assets/document.pdf');
-const fileData = readBinaryData(documentLocation);
-const document = new File([fileData], 'report.pdf', { type: 'application/pdf' });
-const storedDocument = await docManager.storeDocument(document);
-console.log('Загружен документ:', storedDocument);
-
-// Получение перечня документов
-const documentList = await docManager.fetchDocumentList();
-console.log(`Всего документов: ${documentList.items.length}`);
-console.log('Первый документ:', documentList.items[0]);
-
-// Получение сведений о конкретном документе
-const documentInfo = await docManager.retrieveDocument(storedDocument.identifier);
-console.log('Информация о документе:', documentInfo);
-
-// Удаление документа
-const deletionResult = await docManager.removeDocument(storedDocument.identifier);
-console.log('Результат удаления:', deletionResult);
\ No newline at end of file
+"""Пример - работа с хранилищем документов GigaChat"""
+
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dotenv import load_dotenv
+from gigachat import GigaChat
+
+# Настройка подключения
+load_dotenv()
+
+MANIFEST_PATH = "documents_manifest.json"
+MANIFEST_TTL = 300          # Через сколько секунд локальный список документов сверяется с сервером
+HASH_CHUNK_SIZE = 1 << 20   # Файлы хешируются блоками по 1 МБ, без чтения целиком в память
+JOURNAL_PATH = "upload_journal.jsonl"
+UPLOAD_WORKERS = 8          # Сколько файлов загружается одновременно
+UPLOAD_RETRIES = 5
+MANIFEST_SAVE_EVERY = 100   # Как часто сохранять манифест при массовой загрузке
+
+
+def file_digest(path, chunk_size=HASH_CHUNK_SIZE):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DocumentStore:
+    """Клиент хранилища документов с дедупликацией по содержимому.
+
+    Локальный манифест хранит список документов на сервере и соответствие
+    хеш содержимого -> идентификатор документа. Перед загрузкой файл
+    хешируется, и если такой документ уже есть, повторной загрузки нет.
+    """
+
+    def __init__(self, client, manifest_path=MANIFEST_PATH, ttl=MANIFEST_TTL):
+        self.client = client
+        self.manifest_path = manifest_path
+        self.ttl = ttl
+        self.manifest = self._load_manifest()
+        self._lock = threading.RLock()
+        self._digest_locks = {}
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"refreshed_at": 0, "documents": {}, "hashes": {}}
+
+    def save_manifest(self):
+        with self._lock:
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _describe(document):
+        return {
+            "id": document.id_,
+            "filename": document.filename,
+            "bytes": document.bytes_,
+            "created_at": document.created_at,
+        }
+
+    def refresh(self, force=False):
+        """Сверяет манифест с сервером, если он устарел"""
+        with self._lock:
+            if force or time.time() - self.manifest["refreshed_at"] >= self.ttl:
+                self._refresh()
+
+    def _refresh(self):
+        remote = {document.id_: self._describe(document) for document in self.client.get_files().data}
+        local = self.manifest["documents"]
+
+        added = remote.keys() - local.keys()
+        removed = local.keys() - remote.keys()
+        for document_id in added:
+            local[document_id] = remote[document_id]
+        for document_id in removed:
+            del local[document_id]
+        # Хеши удаленных на сервере документов больше не ведут к копии
+        self.manifest["hashes"] = {
+            digest: document_id for digest, document_id in self.manifest["hashes"].items()
+            if document_id in local
+        }
+        self.manifest["refreshed_at"] = time.time()
+        self.save_manifest()
+
+    def find_duplicate(self, digest):
+        """Идентификатор уже загруженного документа с таким содержимым"""
+        self.refresh()
+        return self.manifest["hashes"].get(digest)
+
+    def store_document(self, path, filename=None, mime_type="application/pdf", digest=None, save=True):
+        """Загружает файл, если документа с таким содержимым еще нет.
+
+        Файл передается открытым дескриптором, и HTTP-клиент читает его
+        блоками, поэтому размер файла не влияет на расход памяти.
+        Возвращает пару (идентификатор документа, был ли файл загружен).
+        """
+        digest = digest or file_digest(path)
+        # Одинаковые файлы из разных потоков загружаются только один раз
+        with self._lock:
+            digest_lock = self._digest_locks.setdefault(digest, threading.Lock())
+        try:
+            with digest_lock:
+                document_id = self.find_duplicate(digest)
+                if document_id:
+                    return document_id, False
+
+                with open(path, "rb") as f:
+                    document = self.client.upload_file((filename or os.path.basename(path), f, mime_type))
+                with self._lock:
+                    self.manifest["documents"][document.id_] = self._describe(document)
+                    self.manifest["hashes"][digest] = document.id_
+        finally:
+            with self._lock:
+                self._digest_locks.pop(digest, None)
+
+        if save:
+            self.save_manifest()
+        return document.id_, True
+
+    def iter_documents(self, page_size=100):
+        """Отдает список документов страницами, не собирая его в памяти заново"""
+        self.refresh()
+        documents = sorted(self.manifest["documents"].values(), key=lambda d: d["created_at"] or 0)
+        for start in range(0, len(documents), page_size):
+            yield documents[start:start + page_size]
+
+    def retrieve_document(self, document_id):
+        return self.client.get_file(document_id)
+
+    def remove_document(self, document_id):
+        result = self.client.delete_file(document_id)
+        with self._lock:
+            self.manifest["documents"].pop(document_id, None)
+            self.manifest["hashes"] = {
+                digest: stored_id for digest, stored_id in self.manifest["hashes"].items()
+                if stored_id != document_id
+            }
+            self.save_manifest()
+        return result
+
+
+class BulkUploader:
+    """Массовая загрузка каталога с возобновлением.
+
+    Файлы загружаются несколькими потоками через общий пул соединений
+    клиента GigaChat; одновременно в работе не больше workers * 2 файлов.
+    Каждый обработанный файл записывается в журнал, и повторный запуск
+    пропускает файлы, которые с тех пор не менялись, даже не хешируя их.
+    """
+
+    def __init__(self, store, journal_path=JOURNAL_PATH, workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES):
+        self.store = store
+        self.journal_path = journal_path
+        self.workers = workers
+        self.retries = retries
+        self._journal_lock = threading.Lock()
+        self._done = self._load_journal()
+
+    def _load_journal(self):
+        done = set()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Строка, оборванная при аварийной остановке
+                    done.add((entry["path"], entry["size"], entry["mtime"]))
+        return done
+
+    def _record(self, entry):
+        with self._journal_lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _upload(self, path, stat):
+        digest = file_digest(path)
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        for attempt in range(self.retries):
+            try:
+                document_id, uploaded = self.store.store_document(
+                    path, mime_type=mime_type, digest=digest, save=False
+                )
+                break
+            except Exception as e:
+                if attempt == self.retries - 1:
+                    raise
+                delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"Ошибка загрузки {path}: {e}. Повтор через {delay:.1f} с")
+                time.sleep(delay)
+
+        self._record({
+            "path": path, "size": stat.st_size, "mtime": stat.st_mtime,
+            "sha256": digest, "id": document_id, "uploaded": uploaded,
+        })
+        return uploaded
+
+    def iter_files(self, directory):
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.abspath(os.path.join(root, name))
+                stat = os.stat(path)
+                if (path, stat.st_size, stat.st_mtime) not in self._done:
+                    yield path, stat
+
+    def upload_directory(self, directory):
+        """Загружает все новые файлы каталога; возвращает счетчики результатов"""
+        stats = {"uploaded": 0, "duplicates": 0, "failed": 0}
+        self.store.refresh(force=True)
+        processed = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            files = self.iter_files(directory)
+            while True:
+                # Подкладываем задания порциями, чтобы не держать в памяти весь каталог
+                for path, stat in files:
+                    pending[executor.submit(self._upload, path, stat)] = path
+                    if len(pending) >= self.workers * 2:
+                        break
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path = pending.pop(future)
+                    try:
+                        stats["uploaded" if future.result() else "duplicates"] += 1
+                    except Exception as e:
+                        stats["failed"] += 1
+                        print(f"Не удалось загрузить {path}: {e}")
+                    processed += 1
+                    if processed % MANIFEST_SAVE_EVERY == 0:
+                        self.store.save_manifest()
+
+        self.store.save_manifest()
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Работа с хранилищем документов GigaChat")
+    parser.add_argument("--bulk", metavar="DIR", help="Загрузить все новые файлы каталога")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS)
+    args = parser.parse_args()
+
+    with GigaChat(
+        verify_ssl_certs=False,
+        timeout=600,
+        model="GigaChat-Pro",
+    ) as giga:
+        store = DocumentStore(giga)
+
+        if args.bulk:
+            # Массовая загрузка каталога с журналом для возобновления
+            result = BulkUploader(store, workers=args.workers).upload_directory(args.bulk)
+            print(f"Загружено: {result['uploaded']}, дубликатов: {result['duplicates']}, ошибок: {result['failed']}")
+            raise SystemExit(1 if result["failed"] else 0)
+
+        # Добавление нового документа (повторный запуск не загружает его снова)
+        document_location = os.path.abspath("./assets/document.pdf")
+        document_id, uploaded = store.store_document(document_location, "report.pdf")
+        print("Загружен документ:" if uploaded else "Документ уже в хранилище:", document_id)
+
+        # Получение перечня документов
+        total = 0
+        for page in store.iter_documents():
+            if total == 0 and page:
+                print("Первый документ:", page[0])
+            total += len(page)
+        print(f"Всего документов: {total}")
+
+        # Получение сведений о конкретном документе
+        document_info = store.retrieve_document(document_id)
+        print("Информация о документе:", document_info)
+
+        # Удаление документа
+        deletion_result = store.remove_document(document_id)
+        print("Результат удаления:", deletion_result)
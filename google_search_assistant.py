@@ -1,62 +1,425 @@
 """Пример - использование функций с Google Search"""
 
+import asyncio
 import json
+import math
+import re
+import time
+from collections import Counter, OrderedDict
+from html.parser import HTMLParser
+
+import httpx
 from googlesearch import search as google_search
 
 from gigachat.models import Chat, Function, FunctionParameters, Messages, MessagesRole
 from gigachat import GigaChat
 
+SEARCH_CACHE_TTL = 3600   # Сколько секунд хранить результаты поиска
+SEARCH_CACHE_SIZE = 1000
+TOOL_TIMEOUT = 20         # Таймаут вызова функции по умолчанию, в секундах
+
+FETCH_CONCURRENCY = 5     # Сколько страниц результатов загружаем одновременно
+FETCH_TIMEOUT = 8
+MAX_PAGE_CHARS = 300_000  # Дальше этого объема страницу не читаем
+PASSAGE_WORDS = 60        # Размер фрагмента страницы для ранжирования
+SNIPPET_TOKEN_BUDGET = 900
+
+HISTORY_TOKEN_BUDGET = 6000  # Максимальный размер истории, отправляемой в модель
+KEEP_RECENT_MESSAGES = 6     # Столько последних сообщений никогда не сжимаются
+DIGEST_CHARS = 300           # Размер краткой версии старого результата функции
+
 def search_google(search_query, num_results=3):
-    """Поиск в Google. Возвращает первые N результатов."""
-    try:
-        return "\n".join([result for result in google_search(search_query, num_results=num_results, lang="ru")])
-    except Exception as e:
-        return f"Ошибка поиска: {str(e)}"
-
-# Используйте токен, полученный в личном кабинете из поля Авторизационные данные
-with GigaChat(
-    credentials=...,
-    model=... # Model with functions
-) as giga:
-    search = Function(
-        name="google_search",
-        description="""Поиск в Google.
+    """Поиск в Google. Возвращает ссылки на первые N результатов."""
+    return list(google_search(search_query, num_results=num_results, lang="ru"))
+
+class TextExtractor(HTMLParser):
+    """Потоковый извлекатель основного текста страницы.
+
+    Пропускает скрипты, стили, меню и подвалы, делит текст на абзацы по
+    блочным тегам. Страницу можно подавать кусками по мере загрузки.
+    """
+
+    SKIP_TAGS = {"script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg", "iframe"}
+    BLOCK_TAGS = {"p", "div", "li", "h1", "h2", "h3", "h4", "td", "article", "section", "br", "tr", "pre", "blockquote"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.paragraphs = []
+        self._buffer = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "title":
+            self._in_title = True
+        if tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == "title":
+            self._in_title = False
+        if tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data.strip()
+        elif not self._skip_depth:
+            self._buffer.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _flush(self):
+        text = " ".join("".join(self._buffer).split())
+        self._buffer = []
+        # Короткие строки - обычно кнопки и подписи, а не содержание
+        if len(text.split()) >= 5:
+            self.paragraphs.append(text)
+
+_http_client = None
+
+def get_http_client():
+    """Общий HTTP-клиент с пулом соединений для загрузки страниц"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=FETCH_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=FETCH_CONCURRENCY * 2, max_keepalive_connections=FETCH_CONCURRENCY),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; gigachat-search-assistant)"},
+        )
+    return _http_client
+
+async def fetch_page(url, semaphore):
+    """Загружает страницу и извлекает текст по мере получения данных"""
+    parser = TextExtractor()
+    received = 0
+    async with semaphore:
+        async with get_http_client().stream("GET", url) as response:
+            response.raise_for_status()
+            if "html" not in response.headers.get("content-type", "text/html"):
+                return url, "", []
+            async for chunk in response.aiter_text():
+                parser.feed(chunk)
+                received += len(chunk)
+                if received > MAX_PAGE_CHARS:
+                    break
+    parser.close()
+    return url, parser.title, parser.paragraphs
+
+def tokenize(text):
+    # Обрезка слов до 6 символов - грубая замена стеммингу для русских окончаний
+    return [word[:6] for word in re.findall(r"\w+", text.lower()) if len(word) > 1]
+
+def split_passages(paragraphs, size=PASSAGE_WORDS):
+    """Делит абзацы на фрагменты не длиннее size слов"""
+    passages = []
+    for paragraph in paragraphs:
+        words = paragraph.split()
+        passages += [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+    return passages
+
+def bm25_rank(query, passages, k1=1.5, b=0.75):
+    """Пары (индекс фрагмента, оценка BM25) в порядке убывания релевантности"""
+    documents = [Counter(tokenize(passage)) for passage in passages]
+    if not documents:
+        return []
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) or 1
+    terms = set(tokenize(query))
+    frequency = {term: sum(1 for document in documents if term in document) for term in terms}
+
+    scores = []
+    for document, length in zip(documents, lengths):
+        score = 0.0
+        for term in terms:
+            tf = document.get(term, 0)
+            if tf:
+                idf = math.log(1 + (len(documents) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        scores.append(score)
+    return sorted(enumerate(scores), key=lambda item: item[1], reverse=True)
+
+def estimate_tokens(text):
+    return len(text) // 3 + 1
+
+async def fetch_and_rank(query, urls, budget=SNIPPET_TOKEN_BUDGET):
+    """Собирает самые релевантные фрагменты найденных страниц в пределах бюджета токенов"""
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    pages = await asyncio.gather(*(fetch_page(url, semaphore) for url in urls), return_exceptions=True)
+
+    passages = []
+    titles = {}
+    errors = {}
+    for url, page in zip(urls, pages):
+        if isinstance(page, Exception):
+            errors[url] = str(page) or type(page).__name__
+            continue
+        _, title, paragraphs = page
+        titles[url] = title
+        passages += [(url, passage) for passage in split_passages(paragraphs)]
+
+    selected = {}
+    used = 0
+    for index, score in bm25_rank(query, [passage for _, passage in passages]):
+        if score <= 0:
+            break  # Дальше фрагменты без единого слова из запроса - они только займут бюджет
+        url, passage = passages[index]
+        cost = estimate_tokens(passage)
+        if used + cost > budget:
+            break
+        selected.setdefault(url, []).append(passage)
+        used += cost
+
+    # Страницы без подходящих фрагментов оставляем ссылкой, чтобы модель знала об источнике
+    results = []
+    for url in urls:
+        item = {"url": url, "title": titles.get(url, ""), "snippets": selected.get(url, [])}
+        if url in errors:
+            item["error"] = errors[url]
+        results.append(item)
+    return results
+
+def normalize_query(query):
+    """Ключ кеша: регистр, пробелы и порядок слов в запросе не важны"""
+    return " ".join(sorted(query.lower().split()))
+
+class TTLCache:
+    """Небольшой LRU-кеш, записи которого устаревают через ttl секунд"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+search_cache = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE)
+
+async def google_search_handler(query=None):
+    """Обработчик функции google_search с кешем результатов"""
+    if not query:
+        return ""
+    key = normalize_query(query)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    urls = await asyncio.to_thread(search_google, query)
+    result = await fetch_and_rank(query, urls)
+    # Если не загрузилась ни одна страница, сбой скорее временный - не кешируем его на час
+    if any("error" not in item for item in result):
+        search_cache.set(key, result)
+    return result
+
+class ToolRegistry:
+    """Реестр функций: описание для модели и асинхронный обработчик с таймаутом"""
+
+    def __init__(self):
+        self._tools = {}
+
+    def register(self, function, handler, timeout=TOOL_TIMEOUT):
+        self._tools[function.name] = (function, handler, timeout)
+
+    @property
+    def functions(self):
+        return [function for function, _, _ in self._tools.values()]
+
+    async def call(self, function_call):
+        tool = self._tools.get(function_call.name)
+        if tool is None:
+            return f"Неизвестная функция: {function_call.name}"
+        _, handler, timeout = tool
+        try:
+            return await asyncio.wait_for(handler(**(function_call.arguments or {})), timeout)
+        except asyncio.TimeoutError:
+            return f"Функция {function_call.name} не ответила за {timeout} с"
+        except Exception as e:
+            return f"Ошибка функции {function_call.name}: {str(e)}"
+
+    async def dispatch(self, function_calls):
+        """Выполняет все вызовы функций одного хода параллельно"""
+        return await asyncio.gather(*(self.call(function_call) for function_call in function_calls))
+
+search = Function(
+    name="google_search",
+    description="""Поиск в Google.
 Полезен, когда нужно ответить на вопросы о текущих событиях.
 Входными данными должен быть поисковый запрос.""",
-        parameters=FunctionParameters(
-            type="object",
-            properties={"query": {"type": "string", "description": "Поисковый запрос"}},
-            required=["query"],
-        ),
-    )
+    parameters=FunctionParameters(
+        type="object",
+        properties={"query": {"type": "string", "description": "Поисковый запрос"}},
+        required=["query"],
+    ),
+)
+
+tools = ToolRegistry()
+tools.register(search, google_search_handler)
+
+def digest_function_result(content):
+    """Краткая версия результата функции: источники без текста фрагментов"""
+    try:
+        result = json.loads(content)["result"]
+    except (ValueError, KeyError, TypeError):
+        return content[:DIGEST_CHARS] + "…"
+    if isinstance(result, list) and all(isinstance(item, dict) and "url" in item for item in result):
+        # Сокращаем сами данные, а не готовый JSON: он должен остаться валидным и с пометкой digest
+        sources = []
+        used = 0
+        for item in result:
+            title = item.get("title", "")
+            if len(title) > DIGEST_CHARS // 4:
+                title = title[:DIGEST_CHARS // 4] + "…"
+            source = {"url": item["url"], "title": title}
+            used += len(json.dumps(source, ensure_ascii=False))
+            if sources and used > DIGEST_CHARS * 2:
+                break
+            sources.append(source)
+        return json.dumps({"result": sources, "digest": True}, ensure_ascii=False)
+    return json.dumps({"result": str(result)[:DIGEST_CHARS] + "…", "digest": True}, ensure_ascii=False)
+
+class HistoryManager:
+    """История диалога с ограниченным размером запроса.
+
+    Размер каждого сообщения оценивается один раз при добавлении. Когда
+    история превышает бюджет, старые результаты функций заменяются
+    краткими версиями, а если этого мало - старые ходы сворачиваются
+    моделью в краткое содержание, которое идет первым сообщением.
+    """
+
+    def __init__(self, giga, budget=HISTORY_TOKEN_BUDGET, keep_recent=KEEP_RECENT_MESSAGES):
+        self.giga = giga
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.summary = ""
+        self.messages = []
+        self._sizes = []
+        self.total_tokens = 0
+
+    @staticmethod
+    def _size(message):
+        size = estimate_tokens(message.content or "")
+        if message.function_call:
+            size += estimate_tokens(json.dumps(message.function_call.arguments or {}, ensure_ascii=False))
+        return size
+
+    def append(self, message):
+        size = self._size(message)
+        self.messages.append(message)
+        self._sizes.append(size)
+        self.total_tokens += size
+        if self.total_tokens + estimate_tokens(self.summary) > self.budget:
+            self.compact()
+
+    def request_messages(self):
+        if not self.summary:
+            return self.messages
+        summary = Messages(role=MessagesRole.SYSTEM, content=f"Краткое содержание предыдущего диалога:\n{self.summary}")
+        return [summary] + self.messages
 
-    messages = []
-    function_called = False
-    while True:
-        if not function_called:
-            query = input("\033[92mUser: \033[0m")
-            messages.append(Messages(role=MessagesRole.USER, content=query))
+    def compact(self):
+        old = len(self.messages) - self.keep_recent
+        for i in range(max(old, 0)):
+            if self.messages[i].role == MessagesRole.FUNCTION and '"digest": true' not in self.messages[i].content:
+                self._replace(i, Messages(role=MessagesRole.FUNCTION, content=digest_function_result(self.messages[i].content)))
 
-        chat = Chat(messages=messages, functions=[search])
+        if self.total_tokens + estimate_tokens(self.summary) > self.budget:
+            self._summarize_old_turns()
 
-        resp = giga.chat(chat).choices[0]
-        mess = resp.message
-        messages.append(mess)
+    def _replace(self, index, message):
+        size = self._size(message)
+        self.total_tokens += size - self._sizes[index]
+        self.messages[index] = message
+        self._sizes[index] = size
 
-        print("\033[93m" + f"Bot: \033[0m{mess.content}")
+    def _summarize_old_turns(self):
+        # Сворачиваем только целые ходы: граница - сообщение пользователя,
+        # чтобы не разорвать пару "вызов функции - результат"
+        cut = 0
+        for i in range(len(self.messages) - self.keep_recent, 0, -1):
+            if self.messages[i].role == MessagesRole.USER:
+                cut = i
+                break
+        # Слишком малую часть не сворачиваем, иначе сводка будет запрашиваться на каждом ходу
+        if cut == 0 or sum(self._sizes[:cut]) < self.budget // 4:
+            return
 
+        transcript = "\n".join(
+            f"{message.role}: {message.content or json.dumps(message.function_call.arguments, ensure_ascii=False)}"
+            for message in self.messages[:cut]
+        )
+        request = Chat(messages=[
+            Messages(role=MessagesRole.SYSTEM, content=(
+                "Кратко перескажи диалог: вопросы пользователя, найденные факты и данные ответы. "
+                "Дополни существующее краткое содержание, если оно есть."
+            )),
+            Messages(role=MessagesRole.USER, content=f"Краткое содержание:\n{self.summary}\n\nДиалог:\n{transcript}"),
+        ])
+        try:
+            self.summary = self.giga.chat(request).choices[0].message.content
+        except Exception:
+            return  # Ходы остаются как есть, сводка повторится при следующем сжатии
+
+        self.total_tokens -= sum(self._sizes[:cut])
+        del self.messages[:cut]
+        del self._sizes[:cut]
+
+if __name__ == "__main__":
+    # Используйте токен, полученный в личном кабинете из поля Авторизационные данные
+    with GigaChat(
+        credentials=...,
+        model=... # Model with functions
+    ) as giga:
+        # Один цикл событий на всю сессию, чтобы пул соединений переживал ходы диалога
+        loop = asyncio.new_event_loop()
+        history = HistoryManager(giga)
         function_called = False
-        func_result = ""
-        if resp.finish_reason == "function_call":
-            print("\033[90m" + f"  >> Processing function call {mess.function_call}" + "\033[0m")
-            if mess.function_call.name == "google_search":
-                query = mess.function_call.arguments.get("query", None)
-                if query:
-                    func_result = search_google(query)
-            print("\033[90m" + f"  << Function result: {func_result}\n\n" + "\033[0m")
-
-            messages.append(
-                Messages(role=MessagesRole.FUNCTION,
-                         content=json.dumps({"result": func_result}, ensure_ascii=False))
-            )
-            function_called = True
\ No newline at end of file
+        while True:
+            if not function_called:
+                query = input("\033[92mUser: \033[0m")
+                history.append(Messages(role=MessagesRole.USER, content=query))
+
+            chat = Chat(messages=history.request_messages(), functions=tools.functions)
+
+            resp = giga.chat(chat).choices[0]
+            mess = resp.message
+            history.append(mess)
+
+            print("\033[93m" + f"Bot: \033[0m{mess.content}")
+
+            function_called = False
+            if resp.finish_reason == "function_call":
+                # GigaChat возвращает один вызов за ход, но реестр выполнит параллельно и несколько
+                function_calls = [mess.function_call]
+                for function_call in function_calls:
+                    print("\033[90m" + f"  >> Processing function call {function_call}" + "\033[0m")
+                results = loop.run_until_complete(tools.dispatch(function_calls))
+
+                for func_result in results:
+                    print("\033[90m" + f"  << Function result: {func_result}\n\n" + "\033[0m")
+                    history.append(
+                        Messages(role=MessagesRole.FUNCTION,
+                                 content=json.dumps({"result": func_result}, ensure_ascii=False))
+                    )
+                function_called = True
\ No newline at end of file
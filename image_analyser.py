@@ -1,8 +1,18 @@
 # Импорт необходимых библиотек
+import argparse
 import getpass
+import io
+import json
+import multiprocessing
 import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
 from gigachat import GigaChat
-from PIL import Image
+from gigachat.models import Chat, Messages, MessagesRole
+from PIL import Image, ImageOps
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -12,9 +22,137 @@ def setup_credentials():
     if "GIGACHAT_CREDENTIALS" not in os.environ:
         os.environ["GIGACHAT_CREDENTIALS"] = getpass.getpass("Введите учетные данные GigaChat: ")
 
+ANALYSIS_TASKS = {
+    "general": "Опишите содержание этого изображения максимально подробно",
+    "objects": "Перечислите все основные объекты на изображении",
+    "context": "Проанализируйте контекст и возможное значение изображения",
+    "details": "Опишите детали изображения: цвета, композицию, стиль"
+}
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tiff"}
+
+MODEL_MAX_SIDE = 1024     # Больше этого размера модель деталей не различает
+JPEG_QUALITY = 85
+HASH_DISTANCE = 6         # Изображения с pHash ближе этого расстояния считаются одинаковыми
+CACHE_PATH = "image_analysis_cache.db"
+
+def _dct_matrix(n):
+    """Матрица ортонормированного DCT-II, чтобы считать pHash без SciPy"""
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+DCT_32 = _dct_matrix(32)
+
+def perceptual_hash(img):
+    """64-битный pHash: знаки низкочастотных DCT-коэффициентов относительно медианы"""
+    gray = np.asarray(img.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float32)
+    low = (DCT_32 @ gray @ DCT_32.T)[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+@dataclass
+class PreparedImage:
+    data: bytes   # Уменьшенное изображение в JPEG без метаданных
+    phash: int
+    size: tuple
+
+def prepare_image(image, max_side=MODEL_MAX_SIDE, quality=JPEG_QUALITY):
+    """Уменьшение до полезного для модели размера и компактное перекодирование"""
+    if isinstance(image, PreparedImage):
+        return image
+    if isinstance(image, np.ndarray):
+        img = Image.fromarray(image)
+    elif isinstance(image, Image.Image):
+        img = image
+    else:
+        img = Image.open(image)
+        # JPEG сразу декодируется в уменьшенном масштабе
+        img.draft("RGB", (max_side, max_side))
+
+    # Учитываем поворот из EXIF до того, как метаданные будут отброшены
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        # Прозрачность накладываем на белый фон
+        rgba = np.asarray(img.convert("RGBA"), dtype=np.float32)
+        alpha = rgba[..., 3:] / 255.0
+        img = Image.fromarray((rgba[..., :3] * alpha + 255.0 * (1.0 - alpha)).astype(np.uint8))
+    else:
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality, optimize=True)
+    return PreparedImage(buffer.getvalue(), perceptual_hash(img), img.size)
+
+class PerceptualCache:
+    """Кеш результатов анализа по pHash изображения.
+
+    Результаты хранятся в SQLite отдельно для каждого типа анализа.
+    Хеши одного типа держатся в массиве NumPy, и поиск ближайшего
+    выполняется одной векторной операцией по всему массиву.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_distance=HASH_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._index = {}  # analysis_type -> (массив хешей, список результатов)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS image_results (analysis_type TEXT NOT NULL, phash TEXT NOT NULL, result TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    def _entries(self, analysis_type):
+        if analysis_type not in self._index:
+            rows = self._db.execute(
+                "SELECT phash, result FROM image_results WHERE analysis_type = ?", (analysis_type,)
+            ).fetchall()
+            hashes = np.array([int(phash, 16) for phash, _ in rows], dtype=np.uint64)
+            self._index[analysis_type] = (hashes, [result for _, result in rows])
+        return self._index[analysis_type]
+
+    def get(self, phash, analysis_type):
+        with self._lock:
+            hashes, results = self._entries(analysis_type)
+            if not len(hashes):
+                return None
+            differing = np.bitwise_xor(hashes, np.uint64(phash))
+            distances = np.unpackbits(differing.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            best = int(np.argmin(distances))
+            if distances[best] <= self.max_distance:
+                return json.loads(results[best])
+        return None
+
+    def put(self, phash, analysis_type, result):
+        serialized = json.dumps(result, ensure_ascii=False, default=str)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO image_results VALUES (?, ?, ?)", (analysis_type, f"{phash:016x}", serialized)
+            )
+            self._db.commit()
+            hashes, results = self._entries(analysis_type)
+            self._index[analysis_type] = (np.append(hashes, np.uint64(phash)), results + [serialized])
+
+def iter_image_paths(source):
+    """Пути к изображениям из каталога или из файла-манифеста (по пути в строке или JSONL с полем path)"""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, name)
+        return
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)["path"] if line.startswith("{") else line
+
 # Инициализация анализатора изображений
 class ImageAnalyzer:
-    def __init__(self):
+    def __init__(self, cache_path=CACHE_PATH):
         """Инициализация клиента GigaChat"""
         self.client = GigaChat(
             base_url="https://gigachat-preview.devices.sberbank.ru/api/v1",
@@ -22,6 +160,7 @@ class ImageAnalyzer:
             timeout=600,
             model="GigaChat-Pro-preview",
         )
+        self.cache = PerceptualCache(cache_path) if cache_path else None
     
     def load_image(self, image_path):
         """Загрузка и отображение изображения"""
@@ -37,27 +176,78 @@ class ImageAnalyzer:
             print(f"Ошибка загрузки изображения: {e}")
             return None
     
-    def analyze_image(self, image_array, analysis_type="general"):
-        """Анализ изображения с разными вариантами запросов"""
-        analysis_tasks = {
-            "general": "Опишите содержание этого изображения максимально подробно",
-            "objects": "Перечислите все основные объекты на изображении",
-            "context": "Проанализируйте контекст и возможное значение изображения",
-            "details": "Опишите детали изображения: цвета, композицию, стиль"
-        }
-        
-        task = analysis_tasks.get(analysis_type, analysis_tasks["general"])
-        
+    def analyze_image(self, image, analysis_type="general"):
+        """Анализ изображения с разными вариантами запросов.
+
+        Изображение (путь, массив или PIL.Image) уменьшается и
+        перекодируется; для почти одинаковых изображений результат
+        берется из кеша без обращения к API. Запрос идет тем же путем,
+        что и в analyze_all, поэтому результат - словарь {тип анализа: текст}.
+        """
+        if analysis_type not in ANALYSIS_TASKS:
+            analysis_type = "general"
         try:
-            response = self.client.analyze_image(
-                image=image_array,
-                task=task
-            )
-            return response
+            return self.analyze_all(image, [analysis_type])
         except Exception as e:
             print(f"Ошибка анализа изображения: {e}")
             return None
     
+    def analyze_all(self, image, analysis_types=None):
+        """Несколько видов анализа за одну загрузку изображения.
+
+        Изображение загружается в хранилище GigaChat один раз, затем все
+        задачи выполняются параллельно с вложением по идентификатору файла.
+        Возвращает словарь {тип анализа: результат} для print_analysis_results.
+        """
+        analysis_types = list(analysis_types or ANALYSIS_TASKS)
+        prepared = prepare_image(image)
+
+        results = {}
+        missing = []
+        for analysis_type in analysis_types:
+            cached = self.cache.get(prepared.phash, analysis_type) if self.cache else None
+            # В кеше хранится текст ответа; записи другого вида считаем промахом
+            if isinstance(cached, str):
+                results[analysis_type] = cached
+            else:
+                missing.append(analysis_type)
+        if not missing:
+            return results
+
+        try:
+            uploaded = self.client.upload_file(("image.jpg", prepared.data, "image/jpeg"))
+        except Exception as e:
+            print(f"Ошибка загрузки изображения: {e}")
+            return results or None
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                futures = {
+                    analysis_type: pool.submit(self._run_task, uploaded.id_, analysis_type)
+                    for analysis_type in missing
+                }
+            for analysis_type, future in futures.items():
+                try:
+                    results[analysis_type] = future.result()
+                except Exception as e:
+                    print(f"Ошибка анализа изображения ({analysis_type}): {e}")
+                    continue
+                if self.cache:
+                    self.cache.put(prepared.phash, analysis_type, results[analysis_type])
+        finally:
+            try:
+                self.client.delete_file(uploaded.id_)
+            except Exception:
+                pass  # Файл останется в хранилище, на результат это не влияет
+
+        return {analysis_type: results[analysis_type] for analysis_type in analysis_types if analysis_type in results} or None
+
+    def _run_task(self, file_id, analysis_type):
+        chat = Chat(messages=[
+            Messages(role=MessagesRole.USER, content=ANALYSIS_TASKS[analysis_type], attachments=[file_id])
+        ])
+        return self.client.chat(chat).choices[0].message.content
+
     def print_analysis_results(self, results):
         """Красивый вывод результатов анализа"""
         if not results:
@@ -79,6 +269,89 @@ class ImageAnalyzer:
         
         print("\n" + "="*50)
 
+    def run_batch(self, source, output_path, analysis_type="general", workers=4, in_flight=8):
+        """Пакетный анализ без интерфейса с записью результатов в JSONL.
+
+        Декодирование и уменьшение идут в пуле процессов, запросы к модели - в пуле
+        потоков, и одновременно в работе не больше in_flight изображений.
+        Уже обработанные пути из output_path при повторном запуске
+        пропускаются; частично выполненные (status="partial") повторяются.
+        """
+        done = set()
+        if os.path.exists(output_path):
+            with open(output_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Строка, оборванная при аварийной остановке
+                    if record.get("status") == "ok" and record.get("analysis_type") == analysis_type:
+                        done.add(record["path"])
+
+        stats = {"ok": 0, "partial": 0, "error": 0, "skipped": 0}
+        expected = set(ANALYSIS_TASKS) if analysis_type == "all" else {analysis_type}
+
+        # Процессы-декодеры создаются лениво из потоков отправки; fork при
+        # работающих потоках может зависнуть, поэтому используем spawn
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as decoders, \
+                ThreadPoolExecutor(max_workers=in_flight) as senders, \
+                open(output_path, "a", encoding="utf-8") as output:
+
+            def process(path):
+                prepared = decoders.submit(prepare_image, path).result()
+                if analysis_type == "all":
+                    return self.analyze_all(prepared)
+                return self.analyze_image(prepared, analysis_type)
+
+            pending = {}
+            paths = iter_image_paths(source)
+            while True:
+                for path in paths:
+                    if path in done:
+                        stats["skipped"] += 1
+                        continue
+                    pending[senders.submit(process, path)] = path
+                    if len(pending) >= in_flight:
+                        break
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path = pending.pop(future)
+                    record = {"path": path, "analysis_type": analysis_type}
+                    try:
+                        result = future.result()
+                        if not result:
+                            status = "error"
+                        elif expected <= set(result):
+                            status = "ok"
+                        else:
+                            status = "partial"  # Часть задач не выполнилась - при следующем запуске повторим
+                        record.update(status=status, result=result)
+                    except Exception as e:
+                        record.update(status="error", error=str(e))
+                    stats[record["status"]] += 1
+                    output.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                    output.flush()
+
+        return stats
+
+def batch_main(argv):
+    """Пакетный режим: python image_analyser.py batch <каталог|манифест> -o results.jsonl"""
+    parser = argparse.ArgumentParser(prog="image_analyser.py batch", description="Пакетный анализ изображений")
+    parser.add_argument("source", help="Каталог с изображениями или файл со списком путей")
+    parser.add_argument("-o", "--output", default="analysis_results.jsonl")
+    parser.add_argument("-t", "--type", default="general", choices=list(ANALYSIS_TASKS) + ["all"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Процессов для декодирования")
+    parser.add_argument("--in-flight", type=int, default=8, help="Одновременных запросов к модели")
+    args = parser.parse_args(argv)
+
+    setup_credentials()
+    analyzer = ImageAnalyzer()
+    stats = analyzer.run_batch(args.source, args.output, args.type, args.workers, args.in_flight)
+    print(f"Готово: {stats['ok']}, частично: {stats['partial']}, ошибок: {stats['error']}, пропущено: {stats['skipped']}")
+
 # Основная функция
 def main():
     print("\n" + "="*50)
@@ -96,14 +369,15 @@ def main():
         "1": "general",
         "2": "objects",
         "3": "context",
-        "4": "details"
+        "4": "details",
+        "5": "all"
     }
     
     print("Выберите тип анализа:")
     for num, desc in analysis_types.items():
         print(f"{num}. {desc.capitalize()}")
     
-    choice = input("\nВаш выбор (1-4): ")
+    choice = input("\nВаш выбор (1-5): ")
     analysis_type = analysis_types.get(choice, "general")
     
     # Загрузка изображения
@@ -111,11 +385,17 @@ def main():
     image_array = analyzer.load_image(image_path)
     
     if image_array is not None:
-        # Анализ изображения
-        results = analyzer.analyze_image(image_array, analysis_type)
+        # Анализ изображения: все виды сразу выполняются за одну загрузку
+        if analysis_type == "all":
+            results = analyzer.analyze_all(image_array)
+        else:
+            results = analyzer.analyze_image(image_array, analysis_type)
         
         # Вывод результатов
         analyzer.print_analysis_results(results)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch_main(sys.argv[2:])
+    else:
+        main()
\ No newline at end of file
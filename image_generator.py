@@ -1,12 +1,33 @@
 import os
+import asyncio
+import hashlib
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import uuid
 
 # Инициализация окружения
 load_dotenv()
 
+MAX_CONCURRENT_REQUESTS = 8               # Сколько изображений генерируется одновременно
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CACHE_PATH = "generation_cache.json"      # (модель, промпт, параметры) -> сохраненное изображение
+IMAGES_DIR = "generated_images"
+DEFAULT_PARAMS = {"temperature": 0.7, "max_tokens": 1024}
+STORE_DIR = "image_store"                 # Файлы по хешу содержимого, понятные имена - ссылки на них
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+MAX_CONCURRENT_DOWNLOADS = 8
+
 class ImageCreator:
     def __init__(self):
         self.api_url = "https://gigachat.dev/api/v1"
@@ -24,35 +45,118 @@ class ImageCreator:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         })
+        # Пул соединений рассчитан на параллельные запросы пакетной генерации
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REQUESTS * 2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache_path = CACHE_PATH
+        self._cache_lock = threading.Lock()
+        self._cache = self._load_cache()
+
+    def _load_cache(self):
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _save_cache(self):
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._cache, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.cache_path)
+
+    def _request_data(self, prompt_text, temperature=DEFAULT_PARAMS["temperature"],
+                      max_tokens=DEFAULT_PARAMS["max_tokens"]):
+        return {
+            "model": self.model_name,
+            "messages": [{
+                "role": "user",
+                "content": prompt_text
+            }],
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+
+    def _generate(self, request_data):
+        """Запрос генерации с повторами при 429/5xx и сетевых ошибках"""
+        for attempt in range(MAX_RETRIES):
+            last_attempt = attempt == MAX_RETRIES - 1
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/images/generate",
+                    json=request_data,
+                    timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                response = None
+
+            if response is not None and (response.status_code not in RETRY_STATUSES or last_attempt):
+                response.raise_for_status()
+                image_data = response.json()
+                if not image_data.get("success", False):
+                    raise ValueError("Ошибка генерации изображения")
+                return image_data["image_url"]
+
+            # Экспоненциальная пауза со случайным разбросом, чтобы параллельные запросы не повторялись разом
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else min(60, 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay * 1.5))
+
+    @staticmethod
+    def cache_key(model, prompt_text, params):
+        params = {**DEFAULT_PARAMS, **params}
+        payload = json.dumps({"model": model, "prompt": prompt_text, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cached_image(self, prompt_text, **params):
+        """Путь к уже сгенерированному изображению для этого промпта, если оно есть на диске"""
+        entry = self._cache.get(self.cache_key(self.model_name, prompt_text, params))
+        if entry and os.path.exists(entry["path"]):
+            return entry["path"]
+        return None
+
+    async def generate_batch(self, prompts, concurrency=MAX_CONCURRENT_REQUESTS, **params):
+        """Генерирует и сохраняет изображения для списка промптов.
+
+        Одинаковые промпты генерируются один раз, а изображения из кеша
+        прошлых запусков не генерируются повторно. Возвращает словарь
+        {промпт: путь к файлу или None при ошибке}.
+        """
+        os.makedirs(IMAGES_DIR, exist_ok=True)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def generate_one(prompt_text):
+            path = self.cached_image(prompt_text, **params)
+            if path:
+                return path
+            key = self.cache_key(self.model_name, prompt_text, params)
+            async with semaphore:
+                try:
+                    image_url = await asyncio.to_thread(self._generate, self._request_data(prompt_text, **params))
+                    path = await asyncio.to_thread(
+                        self.save_image, image_url, os.path.join(IMAGES_DIR, f"{key[:16]}.jpg")
+                    )
+                except Exception as e:
+                    print(f"Ошибка при генерации изображения: {str(e)}")
+                    return None
+            if path:
+                with self._cache_lock:
+                    self._cache[key] = {"prompt": prompt_text, "url": image_url, "path": path}
+                    self._save_cache()
+            return path
+
+        unique_prompts = list(dict.fromkeys(prompts))
+        paths = await asyncio.gather(*(generate_one(prompt_text) for prompt_text in unique_prompts))
+        return dict(zip(unique_prompts, paths))
 
     def generate_from_text(self, prompt_text):
         """Создает изображение на основе текстового описания"""
         try:
-            # Формируем запрос для генерации изображения
-            request_data = {
-                "model": self.model_name,
-                "messages": [{
-                    "role": "user",
-                    "content": prompt_text
-                }],
-                "temperature": 0.7,
-                "max_tokens": 1024
-            }
-            
-            # Отправляем запрос к API
-            response = self.session.post(
-                f"{self.api_url}/images/generate",
-                json=request_data,
-                timeout=self.timeout
-            )
-            response.raise_for_status()
-            
-            # Получаем данные изображения
-            image_data = response.json()
-            if not image_data.get("success", False):
-                raise ValueError("Ошибка генерации изображения")
-                
-            return image_data["image_url"]
+            # Формируем запрос и отправляем его к API
+            return self._generate(self._request_data(prompt_text))
             
         except Exception as e:
             print(f"Ошибка при генерации изображения: {str(e)}")
@@ -66,12 +170,8 @@ class ImageCreator:
             filename = f"generated_image_{timestamp}_{uuid.uuid4().hex[:8]}.jpg"
             
         try:
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()
-            
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
+            stored_path = self._download_to_store(image_url, os.path.splitext(filename)[1] or ".jpg")
+            self._link(stored_path, filename)
                     
             print(f"Изображение сохранено как: {filename}")
             return filename
@@ -80,6 +180,65 @@ class ImageCreator:
             print(f"Ошибка при сохранении изображения: {str(e)}")
             return None
 
+    def save_images(self, items, max_workers=MAX_CONCURRENT_DOWNLOADS):
+        """Параллельно сохраняет несколько изображений.
+
+        items - список URL или пар (URL, имя файла). Возвращает список
+        имен сохраненных файлов (None для неудачных загрузок) в том же порядке.
+        """
+        items = [(item, None) if isinstance(item, str) else item for item in items]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda item: self.save_image(*item), items))
+
+    def _download_to_store(self, image_url, extension):
+        """Скачивает файл во временный файл и переносит его в хранилище под именем-хешем"""
+        # Ключ API не должен уходить на сторонние адреса изображений
+        headers = {}
+        if urlsplit(image_url).netloc != urlsplit(self.api_url).netloc:
+            headers["Authorization"] = None
+
+        os.makedirs(STORE_DIR, exist_ok=True)
+        digest = hashlib.sha256()
+        with self.session.get(image_url, stream=True, timeout=self.timeout, headers=headers) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(dir=STORE_DIR, suffix=".part", delete=False) as tmp:
+                try:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                except BaseException:
+                    tmp.close()
+                    os.remove(tmp.name)
+                    raise
+
+        content_hash = digest.hexdigest()
+        stored_path = os.path.join(STORE_DIR, content_hash[:2], content_hash + extension)
+        if os.path.exists(stored_path):
+            # Такое изображение уже есть
+            os.remove(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            os.replace(tmp.name, stored_path)
+        return stored_path
+
+    @staticmethod
+    def _link(stored_path, filename):
+        """Атомарно создает понятное имя файла как символическую ссылку на файл в хранилище"""
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        tmp_link = os.path.join(directory, f".{os.path.basename(filename)}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            os.symlink(os.path.relpath(stored_path, directory), tmp_link)
+        except (OSError, NotImplementedError):
+            # Без прав на символические ссылки (например, в Windows) - жесткая ссылка или копия
+            try:
+                os.link(stored_path, tmp_link)
+            except OSError:
+                shutil.copyfile(stored_path, tmp_link)
+        os.replace(tmp_link, filename)
+
 # Пример использования
 if __name__ == "__main__":
     try:
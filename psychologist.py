@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import asyncio
+import json
 import os
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any
 
 import gigachat
 from gigachat import _models as giga_models
@@ -15,51 +25,435 @@ class DialogueConfig:
     response_length: int = 95
     safety_margin: int = 5
 
-class MentalSupportEngine:
-    def __init__(self, auth_token: str):
-        self._setup_connection(auth_token)
-        self.dialogue_history = []
-        self._initialize_ai_persona(DialogueConfig.ai_persona)
-    
-    def _setup_connection(self, token: str):
-        """Configure secure connection with TLS verification disabled"""
-        self.channel = gigachat.GigaChat(
+@dataclass
+class MemoryConfig:
+    recent_messages: int = 8       # Messages always sent verbatim
+    window_tokens: int = 1200      # Token budget for the verbatim window
+    summary_batch: int = 6         # Evicted messages that trigger a summary refresh
+    max_pending: int = 18          # Unsummarized messages kept if refreshes keep failing
+    summary_tokens: int = 200
+    chars_per_token: float = 3.0
+
+ROLES = (giga_models.MessagesRole.SYSTEM, giga_models.MessagesRole.USER, giga_models.MessagesRole.ASSISTANT)
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+class DialogueMemory:
+    """Bounded dialogue context: pinned persona, rolling summary and recent window.
+
+    Token counts are estimated once per message. Messages pushed out of
+    the window are folded into the summary by a background worker, so
+    the prompt size stays flat however long the session runs.
+
+    Messages are kept as parallel arrays of role codes, token counts and
+    texts; pydantic message objects are only built for the prompt.
+    """
+
+    __slots__ = (
+        "config", "persona", "summary", "window_tokens",
+        "_roles", "_tokens", "_texts", "_pending_roles", "_pending_texts", "_pending_seq",
+        "_summarizer", "_journal", "_lock", "_own_executor", "_executor", "_refresh",
+    )
+
+    def __init__(self, persona: str, summarizer: Callable[[str, List[Any]], str],
+                 config: MemoryConfig = MemoryConfig(), executor: ThreadPoolExecutor = None):
+        self.config = config
+        self.persona = persona
+        self.summary = ""
+        self.window_tokens = 0
+        self._roles = array("B")          # Recent window
+        self._tokens = array("I")
+        self._texts = []
+        self._pending_roles = array("B")  # Evicted messages not yet in the summary
+        self._pending_texts = []
+        self._pending_seq = 0             # Sequence number of the first pending message
+        self._summarizer = summarizer
+        self._journal = None
+        self._lock = threading.RLock()
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._refresh = None
+
+    def estimate_tokens(self, text: str) -> int:
+        return int(len(text) / self.config.chars_per_token) + 1
+
+    def append(self, role, text: str):
+        code = ROLE_CODES[role]
+        with self._lock:
+            self._append(code, text)
+            if self._journal is not None:
+                self._journal.message(code, text)
+            self._schedule_refresh()
+
+    def _append(self, code: int, text: str):
+        self._roles.append(code)
+        self._tokens.append(self.estimate_tokens(text))
+        self._texts.append(sys.intern(text) if len(text) < 16 else text)
+        self.window_tokens += self._tokens[-1]
+        while len(self._roles) > 1 and (
+            len(self._roles) > self.config.recent_messages
+            or self.window_tokens > self.config.window_tokens
+        ):
+            self._pending_roles.append(self._roles.pop(0))
+            self._pending_texts.append(self._texts.pop(0))
+            self.window_tokens -= self._tokens.pop(0)
+        overflow = len(self._pending_texts) - self.config.max_pending
+        if overflow > 0:
+            self._drop_pending(overflow)
+
+    def _drop_pending(self, count: int):
+        del self._pending_roles[:count]
+        del self._pending_texts[:count]
+        self._pending_seq += count
+
+    def _apply_summary(self, summary: str, upto: int):
+        self.summary = summary
+        self._drop_pending(max(0, min(upto - self._pending_seq, len(self._pending_texts))))
+
+    def _schedule_refresh(self):
+        if len(self._pending_texts) < self.config.summary_batch:
+            return
+        if self._refresh is not None and not self._refresh.done():
+            return
+        batch = [
+            giga_models.Messages(role=ROLES[code], content=text)
+            for code, text in zip(self._pending_roles, self._pending_texts)
+        ]
+        upto = self._pending_seq + len(batch)
+        self._refresh = self._executor.submit(self._refresh_summary, self.summary, batch, upto)
+
+    def _refresh_summary(self, summary: str, batch: List[Any], upto: int):
+        try:
+            summary = self._summarizer(summary, batch)
+        except Exception:
+            return  # Keep the batch pending and retry on the next eviction
+        with self._lock:
+            self._apply_summary(summary, upto)
+            if self._journal is not None:
+                self._journal.summary(summary, upto)
+            self._schedule_refresh()
+
+    def build_messages(self) -> List[Any]:
+        """Prompt messages: persona with the summary of older turns, then the recent window.
+
+        GigaChat accepts a single system message, and only as the first
+        message, so the summary is appended to the persona text.
+        """
+        with self._lock:
+            system = self.persona
+            if self.summary:
+                system += f"\n\nКраткое содержание предыдущей беседы: {self.summary}"
+            messages = [giga_models.Messages(role=giga_models.MessagesRole.SYSTEM, content=system)]
+            for roles, texts in ((self._pending_roles, self._pending_texts), (self._roles, self._texts)):
+                messages.extend(giga_models.Messages(role=ROLES[code], content=text) for code, text in zip(roles, texts))
+            return messages
+
+    def state(self) -> Dict[str, Any]:
+        """Snapshot of the memory that load_state can restore"""
+        with self._lock:
+            return {
+                "summary": self.summary,
+                "pending_seq": self._pending_seq,
+                "pending": [[code, text] for code, text in zip(self._pending_roles, self._pending_texts)],
+                "window": [[code, text] for code, text in zip(self._roles, self._texts)],
+            }
+
+    def load_state(self, state: Dict[str, Any]):
+        self.summary = state["summary"]
+        self._pending_seq = state["pending_seq"]
+        for code, text in state["pending"]:
+            self._pending_roles.append(code)
+            self._pending_texts.append(text)
+        for code, text in state["window"]:
+            self._append(code, text)
+
+    def replay(self, entry: Dict[str, Any]):
+        """Apply one journal entry during recovery (no summary refresh is triggered)"""
+        if "m" in entry:
+            self._append(entry["m"], entry["t"])
+        else:
+            self._apply_summary(entry["s"], entry["u"])
+
+    def attach_journal(self, journal: "SessionJournal"):
+        with self._lock:
+            self._journal = journal
+            self._schedule_refresh()
+
+    def close(self):
+        with self._lock:
+            self._journal = None
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+class SessionJournal:
+    """Append-only on-disk log of one session with periodic snapshots.
+
+    Recovery loads the latest snapshot and replays only the log entries
+    written after it.
+    """
+
+    __slots__ = ("memory", "log_path", "snapshot_path", "snapshot_every", "_since_snapshot", "_file")
+
+    def __init__(self, memory: DialogueMemory, log_path: str, snapshot_path: str, snapshot_every: int):
+        self.memory = memory
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self._since_snapshot = 0
+        self._file = open(log_path, "a", encoding="utf-8")
+
+    def message(self, code: int, text: str):
+        self._write({"m": code, "t": text})
+
+    def summary(self, summary: str, upto: int):
+        self._write({"s": summary, "u": upto})
+
+    def _write(self, entry: Dict[str, Any]):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        state = self.memory.state()
+        state["offset"] = self._file.tell()
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+        self._since_snapshot = 0
+
+    def close(self):
+        self._file.close()
+
+class DialogueStore:
+    """Persistent sessions, loaded lazily and evicted from memory when idle.
+
+    Each session is a journal file plus a snapshot in `directory`. An
+    evicted session costs no memory; the next get() restores it from the
+    snapshot and the tail of its journal. Sessions taken with acquire()
+    are never evicted until every lease is released.
+    """
+
+    def __init__(self, directory: str, summarizer: Callable[[str, List[Any]], str],
+                 config: MemoryConfig = MemoryConfig(), executor: ThreadPoolExecutor = None,
+                 idle_ttl: float = 600.0, max_sessions: int = 1000, snapshot_every: int = 50):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.summarizer = summarizer
+        self.config = config
+        self.executor = executor
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.snapshot_every = snapshot_every
+        self._sessions = OrderedDict()  # session_id -> [memory, journal, last_used, leases]
+        self._lock = threading.Lock()
+
+    def _paths(self, session_id: str):
+        if not session_id.replace("-", "").isalnum():
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        base = os.path.join(self.directory, session_id)
+        return base + ".log", base + ".snapshot.json"
+
+    def get(self, session_id: str) -> DialogueMemory:
+        with self._lock:
+            return self._touch(session_id)[0]
+
+    def acquire(self, session_id: str) -> DialogueMemory:
+        """Like get(), but the session stays in memory until release()"""
+        with self._lock:
+            entry = self._touch(session_id)
+            entry[3] += 1
+            return entry[0]
+
+    def release(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None and entry[3] > 0:
+                entry[3] -= 1
+                entry[2] = time.monotonic()
+
+    def _touch(self, session_id: str):
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            memory, journal = self._load(session_id)
+            entry = [memory, journal, 0.0, 0]
+        entry[2] = time.monotonic()
+        self._sessions[session_id] = entry
+        self._evict(keep=session_id)
+        return entry
+
+    def _load(self, session_id: str):
+        log_path, snapshot_path = self._paths(session_id)
+        memory = DialogueMemory(DialogueConfig.ai_persona, self.summarizer, self.config, self.executor)
+        offset = 0
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                state = json.load(f)
+            memory.load_state(state)
+            offset = state["offset"]
+
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        memory.replay(json.loads(line))
+                    except ValueError:
+                        break  # Line cut off by a crash
+                    offset += len(line)
+            # Drop a partially written tail so new entries start on a clean line
+            os.truncate(log_path, offset)
+
+        journal = SessionJournal(memory, log_path, snapshot_path, self.snapshot_every)
+        memory.attach_journal(journal)
+        return memory, journal
+
+    def _evict(self, keep: str = None):
+        now = time.monotonic()
+        for session_id, (memory, journal, last_used, leases) in list(self._sessions.items()):
+            over_limit = len(self._sessions) > self.max_sessions
+            # A leased session still has a live connection writing to its journal
+            if session_id == keep or leases or (not over_limit and now - last_used < self.idle_ttl):
+                continue
+            del self._sessions[session_id]
+            journal.snapshot()
+            memory.close()
+            journal.close()
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict()
+
+    def close(self):
+        with self._lock:
+            for memory, journal, _, _ in self._sessions.values():
+                journal.snapshot()
+                memory.close()
+                journal.close()
+            self._sessions.clear()
+
+class SupportChannel:
+    """Long-lived GigaChat client shared by all turns and sessions.
+
+    The HTTP connection pool stays open between messages, and the access
+    token is refreshed shortly before it expires rather than on demand,
+    so a turn never pays for a TLS handshake or an OAuth round trip.
+    """
+
+    def __init__(self, token: str, refresh_margin: float = 120.0):
+        self.client = gigachat.GigaChat(
             credentials=token,
             verify_ssl_certs=False,
             timeout=30
         )
-    
-    def _initialize_ai_persona(self, system_prompt: str):
-        """Initialize conversation with system role message"""
-        self.dialogue_history.append(
-            giga_models.Messages(
-                role=giga_models.MessagesRole.SYSTEM,
-                content=system_prompt
-            )
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    def _token_expiring(self) -> bool:
+        token = getattr(self.client, "_access_token", None)
+        return token is None or token.expires_at / 1000 - time.time() < self.refresh_margin
+
+    def chat(self, request):
+        if self._token_expiring():
+            with self._lock:
+                if self._token_expiring():
+                    self.client.get_token()
+        return self.client.chat(request)
+
+    async def achat(self, request):
+        if self._token_expiring():
+            if self._async_lock is None:
+                self._async_lock = asyncio.Lock()
+            async with self._async_lock:
+                if self._token_expiring():
+                    await self.client.aget_token()
+        return await self.client.achat(request)
+
+    def summarize(self, summary: str, messages: List[Any], max_tokens: int = MemoryConfig.summary_tokens) -> str:
+        """Fold dialogue messages into a rolling summary"""
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+        request = giga_models.Chat(
+            messages=[
+                giga_models.Messages(
+                    role=giga_models.MessagesRole.SYSTEM,
+                    content="Обнови краткое содержание беседы психолога с клиентом: "
+                            "сохрани ключевые переживания, факты и договоренности."
+                ),
+                giga_models.Messages(
+                    role=giga_models.MessagesRole.USER,
+                    content=f"Текущее содержание: {summary or 'нет'}\n\nНовые реплики:\n{transcript}"
+                ),
+            ],
+            temperature=0.2,
+            max_tokens=max_tokens
         )
+        return self.chat(request).choices[0].message.content
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+class MentalSupportEngine:
+    def __init__(self, auth_token: str = None, memory_config: MemoryConfig = MemoryConfig(),
+                 channel: SupportChannel = None, summary_executor: ThreadPoolExecutor = None,
+                 memory: DialogueMemory = None):
+        self._owns_channel = channel is None
+        self.channel = channel or self._setup_connection(auth_token)
+        # A memory handed in by DialogueStore belongs to the store
+        self._owns_memory = memory is None
+        self.memory = memory or DialogueMemory(DialogueConfig.ai_persona, self._summarize, memory_config, summary_executor)
+
+    @property
+    def dialogue_history(self):
+        return self.memory.build_messages()
     
-    def process_user_input(self, human_input: str) -> str:
-        """Process user message and generate AI response"""
+    def _setup_connection(self, token: str) -> SupportChannel:
+        """Configure secure connection with TLS verification disabled"""
+        return SupportChannel(token)
+    
+    def _summarize(self, summary: str, messages: List[Any]) -> str:
+        """Fold evicted messages into the rolling summary (runs in background)"""
+        return self.channel.summarize(summary, messages, self.memory.config.summary_tokens)
+
+    def _build_conversation(self, human_input: str):
         self._update_dialogue_history(human_input, is_user=True)
-        
-        conversation = giga_models.Chat(
-            messages=self.dialogue_history,
+        return giga_models.Chat(
+            messages=self.memory.build_messages(),
             temperature=DialogueConfig.conversation_temp,
             max_tokens=DialogueConfig.response_length
         )
+
+    def process_user_input(self, human_input: str) -> str:
+        """Process user message and generate AI response"""
+        conversation = self._build_conversation(human_input)
         
-        with self.channel as ai_service:
-            ai_response = ai_service.chat(conversation)
-            bot_reply = self._extract_response_content(ai_response)
+        ai_response = self.channel.chat(conversation)
+        bot_reply = self._extract_response_content(ai_response)
         
         self._update_dialogue_history(bot_reply, is_user=False)
         return bot_reply
+
+    async def aprocess_user_input(self, human_input: str) -> str:
+        """Async variant of process_user_input for the multi-session server"""
+        conversation = self._build_conversation(human_input)
+        bot_reply = self._extract_response_content(await self.channel.achat(conversation))
+        self._update_dialogue_history(bot_reply, is_user=False)
+        return bot_reply
+
+    def close(self):
+        if self._owns_memory:
+            self.memory.close()
+        if self._owns_channel:
+            self.channel.close()
     
     def _update_dialogue_history(self, text: str, is_user: bool):
         """Maintain conversation context"""
         message_type = giga_models.MessagesRole.USER if is_user else giga_models.MessagesRole.ASSISTANT
-        self.dialogue_history.append(
-            giga_models.Messages(role=message_type, content=text)
+        self.memory.append(message_type, text)
     
     def _extract_response_content(self, response) -> str:
         """Safely extract message content from response"""
@@ -84,10 +478,111 @@ def interactive_session(engine):
             print("\nСессия завершена.")
             break
 
+class SupportServer:
+    """Async multi-session server over a single shared GigaChat client.
+
+    Line protocol: each line from the client is a user message and each
+    line back is the reply. A new connection gets a fresh session id;
+    sending "/session <id>" continues an earlier session from the store.
+    """
+
+    def __init__(self, channel: SupportChannel, store_dir: str = "support_sessions",
+                 host: str = "127.0.0.1", port: int = 8765, max_concurrent_requests: int = 64):
+        self.channel = channel
+        self.host = host
+        self.port = port
+        self.max_concurrent_requests = max_concurrent_requests
+        self._summary_executor = ThreadPoolExecutor(max_workers=4)
+        summarizer = lambda summary, messages: channel.summarize(summary, messages)
+        self.store = DialogueStore(store_dir, summarizer, executor=self._summary_executor)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session_id = uuid.uuid4().hex
+        engine = MentalSupportEngine(channel=self.channel, memory=self.store.acquire(session_id))
+        try:
+            writer.write(f"Сессия поддержки {session_id} начата. Для выхода введите 'quit'\n".encode("utf-8"))
+            await writer.drain()
+            while line := await reader.readline():
+                user_text = line.decode("utf-8", errors="replace").strip()
+                if not user_text:
+                    continue
+                if user_text.lower() in ('выход', 'quit', 'exit'):
+                    break
+                if user_text.startswith("/session "):
+                    new_session_id = user_text.split(maxsplit=1)[1]
+                    try:
+                        memory = self.store.acquire(new_session_id)
+                        engine.close()
+                        self.store.release(session_id)
+                        session_id = new_session_id
+                        engine = MentalSupportEngine(channel=self.channel, memory=memory)
+                        writer.write(f"Сессия {session_id} продолжена\n".encode("utf-8"))
+                    except ValueError as e:
+                        writer.write(f"{e}\n".encode("utf-8"))
+                    await writer.drain()
+                    continue
+                try:
+                    async with self._requests:
+                        response = await engine.aprocess_user_input(user_text)
+                except Exception as e:
+                    # A failed turn must not drop the connection; the message is
+                    # already in the journal and the user can simply try again
+                    response = f"Не удалось получить ответ ({type(e).__name__}). Попробуйте ещё раз."
+                writer.write((" ".join(response.splitlines()) + "\n").encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            engine.close()
+            self.store.release(session_id)
+            writer.close()
+
+    async def _evict_idle_sessions(self, interval: float = 60.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.store.evict_idle()
+
+    async def serve_forever(self):
+        self._requests = asyncio.Semaphore(self.max_concurrent_requests)
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        evictor = asyncio.create_task(self._evict_idle_sessions())
+        print(f"Сервер поддержки слушает {self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            self.store.close()
+            self._summary_executor.shutdown(wait=False)
+            await self.channel.aclose()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот психологической поддержки")
+    parser.add_argument("--serve", action="store_true", help="Run the async multi-session server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--store", default="support_sessions", help="Directory for persistent sessions")
+    parser.add_argument("--session", help="Continue a saved session in interactive mode")
+    args = parser.parse_args()
+
     auth_token = os.getenv("GIGA_TOKEN") or "your_token_here"
     if not auth_token:
         raise ValueError("Необходимо указать токен авторизации")
     
-    support_bot = MentalSupportEngine(auth_token)
-    interactive_session(support_bot)
\ No newline at end of file
+    if args.serve:
+        asyncio.run(SupportServer(SupportChannel(auth_token), args.store, args.host, args.port).serve_forever())
+    elif args.session:
+        channel = SupportChannel(auth_token)
+        store = DialogueStore(args.store, lambda summary, messages: channel.summarize(summary, messages))
+        support_bot = MentalSupportEngine(channel=channel, memory=store.get(args.session))
+        try:
+            interactive_session(support_bot)
+        finally:
+            store.close()
+            channel.close()
+    else:
+        support_bot = MentalSupportEngine(auth_token)
+        try:
+            interactive_session(support_bot)
+        finally:
+            support_bot.close()
\ No newline at end of file
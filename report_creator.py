@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import asyncio
+from abc import ABC, abstractmethod
+import os
+import re
+import sys
 import time
-from dataclasses import dataclass
-from typing import List
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
 
 @dataclass
 class ChatMessage:
     actor: str  # 'system', 'bot' или 'user'
     text: str
 
+DEFAULT_PROMPT = "Составь развёрнутый доклад о московском периоде жизни Пушкина"
+
 class AIStreamHandler:
-    def __init__(self):
+    def __init__(self, prompt: Optional[str] = None, **client_kwargs):
+        """
+        prompt — пользовательский запрос (по умолчанию доклад о Пушкине),
+        client_kwargs — параметры GigaChat (base_url, access_token, model и т.д.)
+        """
         from gigachat import GigaChat as AIClient
         from gigachat.models import Chat as AIConversation
         from gigachat.models import Messages as AIMessage
@@ -23,9 +35,10 @@ class AIStreamHandler:
         self._AIMessage = AIMessage
         self._AIRole = AIRole
         
-        self.chat_history = self._init_chat_history()
+        self.client_kwargs = client_kwargs
+        self.chat_history = self._init_chat_history(prompt or DEFAULT_PROMPT)
 
-    def _init_chat_history(self):
+    def _init_chat_history(self, prompt: str):
         """Инициализирует историю сообщений"""
         return self._AIConversation(
             messages=[
@@ -39,23 +52,422 @@ class AIStreamHandler:
                 ),
                 self._AIMessage(
                     role=self._AIRole.USER,
-                    content="Составь развёрнутый доклад о московском периоде жизни Пушкина"
+                    content=prompt
                 )
             ]
         )
 
-    async def process_stream(self):
-        """Обрабатывает потоковый вывод"""
-        async with self._AIClient() as ai:
+    def create_client(self):
+        """Создаёт клиент GigaChat с параметрами обработчика"""
+        return self._AIClient(**self.client_kwargs)
+
+    async def process_stream(self, on_chunk: Optional[Callable[[float, object], None]] = None, client=None):
+        """
+        Обрабатывает потоковый вывод.
+        on_chunk(timestamp, chunk) вызывается на каждый фрагмент (по умолчанию — печать),
+        client — уже открытый клиент; если не передан, создаётся и закрывается здесь
+        """
+        if on_chunk is None:
+            on_chunk = lambda ts, response: print(f"{ts:.6f} | {response}", flush=True)
+        if client is not None:
+            async for response in client.astream(self.chat_history):
+                on_chunk(time.time(), response)
+            return
+        async with self.create_client() as ai:
             async for response in ai.astream(self.chat_history):
-                print(f"{time.time():.6f} | {response}", flush=True)
+                on_chunk(time.time(), response)
+
+OUTLINE_ITEM = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s*(.+?)\s*$")
+
+@dataclass
+class ReportSection:
+    index: int
+    title: str
+    parts: List[str] = field(default_factory=list)
+    done: bool = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+class OutlineReportEngine:
+    """
+    Генерация отчёта в два этапа: сначала план, затем разделы параллельно.
+    Каждый раздел пишется в свой буфер, а документ выводится в порядке плана:
+    текущий раздел печатается по мере генерации, следующие — как только
+    готовы все предыдущие. Время отчёта ≈ план + самый долгий раздел.
+    """
+
+    def __init__(self, request: str = DEFAULT_PROMPT, max_parallel: int = 4, max_sections: int = 12,
+                 write: Optional[Callable[[str], None]] = None, **client_kwargs):
+        self.request = request
+        self.max_parallel = max_parallel
+        self.max_sections = max_sections
+        self.write = write or self._write_stdout
+        self.handler = AIStreamHandler(prompt=request, **client_kwargs)
+        self.sections: List[ReportSection] = []
+        self._next = 0       # первый ещё не выведенный полностью раздел
+        self._emitted = 0    # сколько символов этого раздела уже выведено
+
+    @staticmethod
+    def _write_stdout(text: str):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def _conversation(self, system: str, user: str):
+        h = self.handler
+        return h._AIConversation(messages=[
+            h._AIMessage(role=h._AIRole.SYSTEM, content=system),
+            h._AIMessage(role=h._AIRole.USER, content=user),
+        ])
+
+    @staticmethod
+    def parse_outline(text: str, limit: int) -> List[str]:
+        """Достаёт заголовки разделов из нумерованного или маркированного списка"""
+        titles = []
+        for line in text.splitlines():
+            match = OUTLINE_ITEM.match(line)
+            if match:
+                title = re.sub(r"[*#]", "", match.group(1)).strip().rstrip(".:")
+                if title:
+                    titles.append(title)
+        return titles[:limit]
+
+    async def generate_outline(self, client) -> List[str]:
+        chat = self._conversation(
+            "Ты - компетентный цифровой ассистент. Ты составляешь планы документов.",
+            f"Составь план для задачи: «{self.request}». "
+            f"Верни только нумерованный список из не более чем {self.max_sections} разделов, "
+            "по одному заголовку на строку, без пояснений."
+        )
+        response = await client.achat(chat)
+        titles = self.parse_outline(response.choices[0].message.content, self.max_sections)
+        # Если модель не вернула список, генерируем отчёт одним разделом
+        return titles or [self.request]
+
+    def _flush(self):
+        """Выводит всё, что можно вывести, не нарушая порядок плана"""
+        while self._next < len(self.sections):
+            section = self.sections[self._next]
+            text = section.text
+            if len(text) > self._emitted:
+                self.write(text[self._emitted:])
+                self._emitted = len(text)
+            if not section.done:
+                return
+            self.write("\n\n")
+            self._next += 1
+            self._emitted = 0
+
+    async def _write_section(self, client, semaphore, section: ReportSection, outline: str):
+        async with semaphore:
+            chat = self._conversation(
+                "Ты - компетентный цифровой ассистент. Ты пишешь один раздел большого отчёта. "
+                "Не повторяй содержание других разделов и не пиши вступление ко всему отчёту.",
+                f"Задача: «{self.request}».\nПлан отчёта:\n{outline}\n\n"
+                f"Напиши подробно раздел {section.index + 1}. «{section.title}». "
+                "Начни с заголовка раздела."
+            )
+            async for chunk in client.astream(chat):
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        section.parts.append(choice.delta.content)
+                if section.index == self._next:
+                    self._flush()
+        section.done = True
+        self._flush()
+
+    async def generate(self, client=None) -> str:
+        """Генерирует отчёт и возвращает его целиком; по ходу выводит через write"""
+        if client is None:
+            async with self.handler.create_client() as ai:
+                return await self.generate(ai)
+
+        titles = await self.generate_outline(client)
+        outline = "\n".join(f"{i + 1}. {title}" for i, title in enumerate(titles))
+        self.sections = [ReportSection(i, title) for i, title in enumerate(titles)]
+        self._next = self._emitted = 0
+
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        tasks = [asyncio.create_task(self._write_section(client, semaphore, section, outline))
+                 for section in self.sections]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return "\n\n".join(section.text for section in self.sections)
+
+class StreamSink(ABC):
+    """
+    Получатель текста одного потока. write может ждать — тогда буфер потока
+    заполняется и чтение ответа модели приостанавливается (backpressure).
+    """
+
+    async def open(self):
+        pass
+
+    @abstractmethod
+    async def write(self, text: str):
+        ...
+
+    async def close(self, error: Optional[BaseException] = None):
+        pass
+
+class StdoutSink(StreamSink):
+    """Печать с префиксом потока, чтобы различать перемешанный вывод"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+
+    async def write(self, text: str):
+        sys.stdout.write(f"{self.prefix}{text}" if self.prefix else text)
+        sys.stdout.flush()
+
+class FileSink(StreamSink):
+    def __init__(self, path: str, encoding: str = "utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self._file = None
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "w", encoding=self.encoding)
+
+    async def write(self, text: str):
+        self._file.write(text)
+
+    async def close(self, error: Optional[BaseException] = None):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class QueueSink(StreamSink):
+    """Кладёт фрагменты в asyncio.Queue; ограниченная очередь тормозит поток, если потребитель отстаёт"""
+
+    def __init__(self, queue: asyncio.Queue, end_marker=None, close_timeout: float = 1.0):
+        self.queue = queue
+        self.end_marker = end_marker
+        self.close_timeout = close_timeout
+
+    async def write(self, text: str):
+        await self.queue.put(text)
+
+    async def close(self, error: Optional[BaseException] = None):
+        # Потребитель мог уйти, а очередь — остаться полной: ждём места недолго,
+        # иначе завершение потока зависнет навсегда
+        marker = error if error is not None else self.end_marker
+        try:
+            self.queue.put_nowait(marker)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(marker), self.close_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+class WebSocketSink(StreamSink):
+    """
+    Отправляет фрагменты в WebSocket. Подходит любой объект с async send(str)
+    (websockets) или send_str(str) (aiohttp); ожидание отправки и есть backpressure.
+    """
+
+    def __init__(self, ws, close_on_end: bool = False):
+        self.ws = ws
+        self.close_on_end = close_on_end
+        self._send = getattr(ws, "send_str", None) or ws.send
+
+    async def write(self, text: str):
+        await self._send(text)
+
+    async def close(self, error: Optional[BaseException] = None):
+        if self.close_on_end:
+            await self.ws.close()
+
+@dataclass
+class StreamJob:
+    stream_id: str
+    chat: object
+    sinks: List[StreamSink]
+    deadline: Optional[float] = None  # секунд на весь поток
+    state: str = "pending"            # pending, running, done, cancelled, timeout, failed
+    error: Optional[BaseException] = None
+    chunks: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    cancel_requested: bool = False    # отмену запросил сам мультиплексор
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+class StreamMultiplexer:
+    """
+    Запускает много потоков astream в одном цикле событий на общем клиенте.
+    У каждого потока своя ограниченная очередь между чтением ответа и sink'ами:
+    медленный получатель останавливает только свой поток, память не растёт.
+    В jobs лежат только активные потоки; завершённые попадают в ограниченную
+    историю, которую забирает join().
+    """
+
+    def __init__(self, max_concurrent: int = 100, buffer_size: int = 64, client=None,
+                 history_size: int = 1000, **client_kwargs):
+        self.max_concurrent = max_concurrent
+        self.buffer_size = buffer_size
+        self.handler = AIStreamHandler(**client_kwargs)
+        self.client = client
+        self._owns_client = client is None
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.jobs = {}
+        self._finished = deque(maxlen=history_size)
+
+    async def __aenter__(self):
+        if self.client is None:
+            self.client = self.handler.create_client()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Отменяет незавершённые потоки и закрывает клиент, если он наш"""
+        pending = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for job in self.jobs.values():
+            job.cancel_requested = True
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if self._owns_client and self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def submit(self, stream_id: str, prompt, sinks: List[StreamSink], deadline: Optional[float] = None) -> StreamJob:
+        """Ставит поток в работу; prompt — строка или готовый Chat"""
+        if stream_id in self.jobs:
+            raise ValueError(f"Поток {stream_id} уже выполняется")
+        if self.client is None:
+            raise RuntimeError("Мультиплексор не запущен: используйте async with")
+        chat = AIStreamHandler(prompt=prompt).chat_history if isinstance(prompt, str) else prompt
+        job = StreamJob(stream_id, chat, list(sinks), deadline)
+        job.task = asyncio.create_task(self._run(job))
+        job.task.add_done_callback(lambda _: self._forget(job))
+        self.jobs[stream_id] = job
+        return job
+
+    def cancel(self, stream_id: str) -> bool:
+        job = self.jobs.get(stream_id)
+        if job is None or job.task is None or job.task.done():
+            return False
+        job.cancel_requested = True
+        job.task.cancel()
+        return True
+
+    async def join(self) -> List[StreamJob]:
+        """Ждёт завершения всех активных потоков и отдаёт завершённые с прошлого вызова"""
+        while self.jobs:
+            tasks = [job.task for job in self.jobs.values() if job.task]
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finished = list(self._finished)
+        self._finished.clear()
+        return finished
+
+    async def _produce(self, job: StreamJob, buffer: asyncio.Queue):
+        async for chunk in self.client.astream(job.chat):
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    job.chunks += 1
+                    await buffer.put(choice.delta.content)
+        await buffer.put(None)
+
+    async def _consume(self, job: StreamJob, buffer: asyncio.Queue):
+        while True:
+            text = await buffer.get()
+            if text is None:
+                return
+            for sink in job.sinks:
+                await sink.write(text)
+
+    async def _pump(self, job: StreamJob):
+        buffer = asyncio.Queue(maxsize=self.buffer_size)
+        producer = asyncio.create_task(self._produce(job, buffer))
+        consumer = asyncio.create_task(self._consume(job, buffer))
+        try:
+            done, _ = await asyncio.wait([producer, consumer], return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+            await asyncio.gather(producer, consumer)
+        finally:
+            for task in (producer, consumer):
+                task.cancel()
+            await asyncio.gather(producer, consumer, return_exceptions=True)
+
+    async def _run(self, job: StreamJob):
+        opened = []
+        try:
+            async with self._semaphore:
+                job.state = "running"
+                job.started = time.monotonic()
+                for sink in job.sinks:
+                    await sink.open()
+                    opened.append(sink)
+                if job.deadline is not None:
+                    await asyncio.wait_for(self._pump(job), job.deadline)
+                else:
+                    await self._pump(job)
+            job.state = "done"
+        except asyncio.TimeoutError as e:
+            job.state, job.error = "timeout", e
+        except asyncio.CancelledError as e:
+            job.state, job.error = "cancelled", e
+            if not job.cancel_requested:
+                raise
+        except Exception as e:
+            job.state, job.error = "failed", e
+        finally:
+            job.finished = time.monotonic()
+            for sink in opened:
+                try:
+                    await sink.close(job.error)
+                except Exception:
+                    pass
+        return job
+
+    def _forget(self, job: StreamJob):
+        """Переносит завершённый поток из активных в историю"""
+        if job.state == "pending":
+            # задачу отменили до первого шага, _run так и не начался
+            job.state, job.finished = "cancelled", time.monotonic()
+        if self.jobs.get(job.stream_id) is job:
+            del self.jobs[job.stream_id]
+        self._finished.append(job)
 
-async def execute():
-    handler = AIStreamHandler()
+async def execute(args):
+    if args.streams:
+        async with StreamMultiplexer(max_concurrent=args.streams, buffer_size=args.buffer) as mux:
+            for i in range(args.streams):
+                path = os.path.join(args.out, f"stream_{i + 1}.txt")
+                mux.submit(f"stream-{i + 1}", args.prompt, [FileSink(path)], deadline=args.deadline)
+            for job in await mux.join():
+                print(f"{job.stream_id}: {job.state}, фрагментов {job.chunks}, "
+                      f"{job.finished - (job.started or job.finished):.1f} с")
+        return
+    if args.parallel:
+        engine = OutlineReportEngine(args.prompt, max_parallel=args.parallel, max_sections=args.sections)
+        await engine.generate()
+        return
+    handler = AIStreamHandler(prompt=args.prompt)
     await handler.process_stream()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Потоковая генерация отчёта")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--parallel", type=int, default=0,
+                        help="Генерировать по плану, N разделов одновременно")
+    parser.add_argument("--sections", type=int, default=12, help="Максимум разделов в плане")
+    parser.add_argument("--streams", type=int, default=0,
+                        help="Запустить N потоков одновременно с выводом в файлы")
+    parser.add_argument("--out", default="reports", help="Каталог для --streams")
+    parser.add_argument("--buffer", type=int, default=64, help="Размер буфера потока, фрагментов")
+    parser.add_argument("--deadline", type=float, help="Ограничение времени на поток, с")
     try:
-        asyncio.run(execute())
+        asyncio.run(execute(parser.parse_args()))
     except KeyboardInterrupt:
         print("\nСеанс завершён")
\ No newline at end of file
@@ -15,8 +15,91 @@ const client = new GigaChat({
     httpsAgent: httpsAgent,
 });
 
-let message = "";
-for await (const chunk of client.stream('Напиши отчет на тему ипотечного кредитования')) {
-    message += chunk.choices[0]?.delta.content;
+const REQUEST = 'Напиши отчет на тему ипотечного кредитования';
+const MAX_PARALLEL = 4;   // разделов генерируется одновременно
+const MAX_SECTIONS = 12;
+
+// Сначала просим план, затем пишем разделы параллельно.
+// Каждый раздел копится в своём буфере, а вывод идёт в порядке плана:
+// текущий раздел печатается по мере генерации, следующие — как только готовы предыдущие.
+function parseOutline(text) {
+    const titles = [];
+    for (const line of text.split('\n')) {
+        const match = line.match(/^\s*(?:\d+[.)]|[-*•])\s*(.+?)\s*$/);
+        if (match) {
+            const title = match[1].replace(/[*#]/g, '').trim().replace(/[.:]+$/, '');
+            if (title) titles.push(title);
+        }
+    }
+    return titles.slice(0, MAX_SECTIONS);
+}
+
+async function generateOutline() {
+    const response = await client.chat({
+        messages: [
+            { role: 'system', content: 'Ты составляешь планы документов.' },
+            {
+                role: 'user',
+                content: `Составь план для задачи: «${REQUEST}». Верни только нумерованный список ` +
+                    `из не более чем ${MAX_SECTIONS} разделов, по одному заголовку на строку, без пояснений.`,
+            },
+        ],
+    });
+    const titles = parseOutline(response.choices[0]?.message.content ?? '');
+    return titles.length ? titles : [REQUEST];
+}
+
+const titles = await generateOutline();
+const outline = titles.map((title, i) => `${i + 1}. ${title}`).join('\n');
+const sections = titles.map((title) => ({ title, text: '', done: false }));
+let next = 0;     // первый ещё не выведенный полностью раздел
+let emitted = 0;  // сколько символов этого раздела уже выведено
+
+function flush() {
+    while (next < sections.length) {
+        const section = sections[next];
+        if (section.text.length > emitted) {
+            process.stdout.write(section.text.slice(emitted));
+            emitted = section.text.length;
+        }
+        if (!section.done) return;
+        process.stdout.write('\n\n');
+        next += 1;
+        emitted = 0;
+    }
 }
+
+async function writeSection(index) {
+    const section = sections[index];
+    const payload = {
+        messages: [
+            {
+                role: 'system',
+                content: 'Ты пишешь один раздел большого отчёта. ' +
+                    'Не повторяй содержание других разделов и не пиши вступление ко всему отчёту.',
+            },
+            {
+                role: 'user',
+                content: `Задача: «${REQUEST}».\nПлан отчёта:\n${outline}\n\n` +
+                    `Напиши подробно раздел ${index + 1}. «${section.title}». Начни с заголовка раздела.`,
+            },
+        ],
+    };
+    for await (const chunk of client.stream(payload)) {
+        section.text += chunk.choices[0]?.delta.content ?? '';
+        if (index === next) flush();
+    }
+    section.done = true;
+    flush();
+}
+
+let cursor = 0;
+const workers = Array.from({ length: Math.min(MAX_PARALLEL, sections.length) }, async () => {
+    while (cursor < sections.length) {
+        await writeSection(cursor++);
+    }
+});
+await Promise.all(workers);
+
+let message = sections.map((section) => section.text).join('\n\n');
 message
\ No newline at end of file
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный замер потоковой генерации на базе AIStreamHandler из report_creator.py.
+
+Прогоняет набор запросов с заданной конкурентностью и считает время до первого
+фрагмента (TTFT), паузы между фрагментами, токены в секунду и перцентили
+p50/p95/p99. Отчёт сохраняется в JSON/CSV, прогон можно сравнить с эталонным.
+
+Примеры:
+    python stream_benchmark.py --mock --requests 200 --concurrency 20 --json run.json
+    python stream_benchmark.py --base-url https://gigachat.devices.sberbank.ru/api/v1 \\
+        --prompts prompts.txt --concurrency 8 --json run.json --baseline last.json
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from report_creator import AIStreamHandler, DEFAULT_PROMPT
+
+PERCENTILES = (50, 95, 99)
+# Метрики для сравнения прогонов: (раздел, ключ, чем больше — тем хуже)
+REGRESSION_METRICS = [
+    ("ttft", "p50", True),
+    ("ttft", "p95", True),
+    ("ttft", "p99", True),
+    ("gap", "p95", True),
+    ("gap", "p99", True),
+    ("total", "p95", True),
+    ("tokens_per_sec", "p50", False),
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов, если сервер не вернул usage"""
+    return max(1, len(text) // 3) if text else 0
+
+
+class MockStreamingServer:
+    """
+    Локальный сервер, отдающий /chat/completions в формате SSE, как GigaChat.
+    Задержки настраиваются, чтобы имитировать TTFT и темп генерации.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, ttft: float = 0.2,
+                 chunk_delay: float = 0.03, jitter: float = 0.01, chunks: int = 40,
+                 error_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/api/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _read_request(self, reader):
+        """Читает заголовки и тело HTTP-запроса"""
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(length) if length else b""
+        return request_line, body
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line, _ = await self._read_request(reader)
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] != "POST" or not parts[1].rstrip("/").endswith("chat/completions"):
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            if self.error_rate and random.random() < self.error_rate:
+                payload = b'{"status":503,"message":"mock overload"}'
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(payload)).encode() + b"\r\nConnection: close\r\n\r\n"
+                             + payload)
+                return
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            await asyncio.sleep(self.ttft)
+            created = int(time.time())
+            text_len = 0
+            for i in range(self.chunks):
+                if i:
+                    await asyncio.sleep(max(0.0, self.chunk_delay + random.uniform(-self.jitter, self.jitter)))
+                content = f"фрагмент {i} "
+                text_len += len(content)
+                chunk = {
+                    "choices": [{"delta": {"content": content, "role": "assistant"}, "index": 0}],
+                    "created": created, "model": "mock", "object": "chat.completion",
+                }
+                if i == self.chunks - 1:
+                    chunk["choices"][0]["finish_reason"] = "stop"
+                    completion = estimate_tokens("x" * text_len)
+                    chunk["usage"] = {"prompt_tokens": 0, "completion_tokens": completion,
+                                      "total_tokens": completion}
+                writer.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await writer.drain()
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+@dataclass
+class RequestResult:
+    """Замеры одного потокового запроса (все времена в секундах)"""
+    index: int
+    prompt: str
+    ttft: Optional[float] = None
+    total: Optional[float] = None
+    chunks: int = 0
+    tokens: int = 0
+    tokens_per_sec: Optional[float] = None
+    gaps: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+async def measure_request(index: int, prompt: str, client, client_kwargs: Dict) -> RequestResult:
+    """Выполняет один запрос через AIStreamHandler и снимает тайминги фрагментов"""
+    handler = AIStreamHandler(prompt=prompt, **client_kwargs)
+    result = RequestResult(index=index, prompt=prompt)
+    stamps = []
+    text_parts = []
+    reported_tokens = None
+
+    def on_chunk(_, chunk):
+        nonlocal reported_tokens
+        stamps.append(time.perf_counter())
+        for choice in chunk.choices:
+            if choice.delta.content:
+                text_parts.append(choice.delta.content)
+        usage = getattr(chunk, "usage", None)
+        if usage is not None and usage.completion_tokens:
+            reported_tokens = usage.completion_tokens
+
+    started = time.perf_counter()
+    try:
+        await handler.process_stream(on_chunk=on_chunk, client=client)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finished = time.perf_counter()
+
+    result.total = finished - started
+    result.chunks = len(stamps)
+    if stamps:
+        result.ttft = stamps[0] - started
+        result.gaps = [b - a for a, b in zip(stamps, stamps[1:])]
+    result.tokens = reported_tokens or estimate_tokens("".join(text_parts))
+    # Скорость генерации считается после первого фрагмента, чтобы не смешивать её с TTFT
+    generation_time = (stamps[-1] - stamps[0]) if len(stamps) > 1 else result.total
+    if result.tokens and generation_time > 0:
+        result.tokens_per_sec = result.tokens / generation_time
+    return result
+
+
+async def run_benchmark(prompts: List[str], requests: int, concurrency: int,
+                        client_kwargs: Dict, warmup: int = 0):
+    """
+    Прогоняет requests запросов (промпты берутся по кругу) не более чем по concurrency одновременно.
+    Все запросы идут через один клиент, как в продуктиве. Возвращает (результаты, время прогона).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    client = AIStreamHandler(**client_kwargs).create_client()
+
+    async def bounded(index):
+        async with semaphore:
+            return await measure_request(index, prompts[index % len(prompts)], client, client_kwargs)
+
+    try:
+        if warmup:
+            await asyncio.gather(*(bounded(i) for i in range(warmup)))
+        started = time.perf_counter()
+        results = await asyncio.gather(*(bounded(i) for i in range(requests)))
+        wall_time = time.perf_counter() - started
+    finally:
+        await client.aclose()
+    return list(results), wall_time
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль с линейной интерполяцией между соседними значениями"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def describe(values: List[float]) -> Dict[str, Optional[float]]:
+    stats = {f"p{q}": percentile(values, q) for q in PERCENTILES}
+    stats["mean"] = sum(values) / len(values) if values else None
+    stats["max"] = max(values) if values else None
+    stats["count"] = len(values)
+    return stats
+
+
+def summarize(results: List[RequestResult], wall_time: float, concurrency: int) -> Dict:
+    ok = [r for r in results if r.error is None]
+    total_tokens = sum(r.tokens for r in ok)
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "concurrency": concurrency,
+        "wall_time": wall_time,
+        "requests_per_sec": len(ok) / wall_time if wall_time else None,
+        "aggregate_tokens_per_sec": total_tokens / wall_time if wall_time else None,
+        "ttft": describe([r.ttft for r in ok if r.ttft is not None]),
+        "gap": describe([gap for r in ok for gap in r.gaps]),
+        "total": describe([r.total for r in ok]),
+        "tokens_per_sec": describe([r.tokens_per_sec for r in ok if r.tokens_per_sec is not None]),
+    }
+
+
+def write_json(path: str, summary: Dict, results: List[RequestResult], meta: Dict):
+    report = {"meta": meta, "summary": summary, "results": [asdict(r) for r in results]}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def write_csv(path: str, results: List[RequestResult]):
+    columns = ["index", "ttft", "total", "chunks", "tokens", "tokens_per_sec",
+               "gap_p50", "gap_p95", "gap_max", "error", "prompt"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for r in results:
+            writer.writerow({
+                "index": r.index, "ttft": r.ttft, "total": r.total, "chunks": r.chunks,
+                "tokens": r.tokens, "tokens_per_sec": r.tokens_per_sec,
+                "gap_p50": percentile(r.gaps, 50), "gap_p95": percentile(r.gaps, 95),
+                "gap_max": max(r.gaps) if r.gaps else None,
+                "error": r.error or "", "prompt": r.prompt,
+            })
+
+
+def compare_runs(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Сравнивает сводки двух прогонов. threshold — допустимое ухудшение в процентах.
+    Возвращает список описаний регрессий (пустой, если их нет).
+    """
+    regressions = []
+    for section, key, higher_is_worse in REGRESSION_METRICS:
+        new = current.get(section, {}).get(key)
+        old = baseline.get(section, {}).get(key)
+        if new is None or not old:
+            continue
+        change = (new - old) / old * 100
+        worse = change if higher_is_worse else -change
+        if worse > threshold:
+            regressions.append(f"{section}.{key}: {old:.4f} -> {new:.4f} ({change:+.1f}%)")
+    if current.get("error_rate", 0) > baseline.get("error_rate", 0) + threshold / 100:
+        regressions.append(f"error_rate: {baseline.get('error_rate', 0):.2%} -> {current['error_rate']:.2%}")
+    return regressions
+
+
+def print_summary(summary: Dict):
+    print(f"Запросов: {summary['requests']}, ошибок: {summary['errors']}, "
+          f"конкурентность: {summary['concurrency']}, время: {summary['wall_time']:.2f} с")
+    if summary["requests_per_sec"] is not None:
+        print(f"Пропускная способность: {summary['requests_per_sec']:.2f} запр/с, "
+              f"{summary['aggregate_tokens_per_sec']:.1f} ток/с")
+    for section, title, unit in [("ttft", "TTFT", "мс"), ("gap", "Паузы", "мс"),
+                                 ("total", "Полное время", "мс"), ("tokens_per_sec", "Токены/с", "")]:
+        stats = summary[section]
+        if not stats["count"]:
+            continue
+        scale = 1000 if unit else 1
+        values = ", ".join(f"p{q}={stats[f'p{q}'] * scale:.1f}" for q in PERCENTILES)
+        print(f"  {title:<13} {values} {unit}")
+
+
+def load_prompts(path: Optional[str]) -> List[str]:
+    """Читает промпты из файла (по одному на строку); без файла — стандартный запрос"""
+    if not path:
+        return [DEFAULT_PROMPT]
+    with open(path, encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()]
+    if not prompts:
+        raise ValueError(f"В файле {path} нет промптов")
+    return prompts
+
+
+async def run(args) -> int:
+    prompts = load_prompts(args.prompts)
+    client_kwargs = {"verify_ssl_certs": False}
+    if args.timeout:
+        client_kwargs["timeout"] = args.timeout
+    if args.model:
+        client_kwargs["model"] = args.model
+
+    mock = None
+    if args.mock:
+        mock = await MockStreamingServer(ttft=args.mock_ttft, chunk_delay=args.mock_delay,
+                                         jitter=args.mock_jitter, chunks=args.mock_chunks,
+                                         error_rate=args.mock_error_rate).start()
+        client_kwargs.update(base_url=mock.base_url, access_token="mock")
+        client_kwargs.setdefault("model", "mock")
+    elif args.base_url:
+        client_kwargs["base_url"] = args.base_url
+
+    try:
+        results, wall_time = await run_benchmark(prompts, args.requests, args.concurrency,
+                                                 client_kwargs, warmup=args.warmup)
+    finally:
+        if mock is not None:
+            await mock.stop()
+
+    summary = summarize(results, wall_time, args.concurrency)
+    print_summary(summary)
+
+    meta = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "endpoint": client_kwargs.get("base_url", "default"),
+        "model": args.model,
+        "prompts": len(prompts),
+    }
+    if args.json:
+        write_json(args.json, summary, results, meta)
+    if args.csv:
+        write_csv(args.csv, results)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+        regressions = compare_runs(summary, baseline, args.threshold)
+        if regressions:
+            print(f"Регрессии относительно {args.baseline} (порог {args.threshold}%):")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"Регрессий относительно {args.baseline} нет")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замер задержек потоковой генерации")
+    parser.add_argument("--mock", action="store_true", help="Запустить встроенный тестовый сервер")
+    parser.add_argument("--base-url", help="Адрес API (по умолчанию из настроек GigaChat)")
+    parser.add_argument("--model")
+    parser.add_argument("--prompts", help="Файл с промптами, по одному на строку")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=0, help="Запросов прогрева, не входят в отчёт")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--json", help="Сохранить отчёт в JSON")
+    parser.add_argument("--csv", help="Сохранить замеры по запросам в CSV")
+    parser.add_argument("--baseline", help="JSON-отчёт прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Допустимое ухудшение, %%")
+    parser.add_argument("--mock-ttft", type=float, default=0.2)
+    parser.add_argument("--mock-delay", type=float, default=0.03)
+    parser.add_argument("--mock-jitter", type=float, default=0.01)
+    parser.add_argument("--mock-chunks", type=int, default=40)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    if args.concurrency < 1 or args.requests < 1:
+        parser.error("--requests и --concurrency должны быть положительными")
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print("\nЗамер прерван")
@@ -1,7 +1,359 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
 import streamlit as st
 from langchain_community.chat_models import GigaChat
 from langchain.schema import ChatMessage
 
+CLIENT_IDLE_TTL = 15 * 60      # секунд простоя, после которых клиент закрывается
+TOKEN_REFRESH_MARGIN = 120     # обновлять токен за столько секунд до истечения
+MAX_POOLED_CLIENTS = 32
+
+IMAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".image_cache")
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IMAGE_WIDTH = 450
+HISTORY_RECENT_MESSAGES = 20   # последние сообщения, которые всегда на экране
+HISTORY_PAGE_SIZE = 20         # размер страницы свёрнутой истории
+
+FRAME_INTERVAL = 0.08          # не чаще одной перерисовки за столько секунд...
+FRAME_CHARS = 400              # ...если не накопилось столько новых символов
+SEGMENT_CHARS = 2000           # более длинный текстовый фрагмент замораживается на границе абзаца
+IMAGE_FETCH_WORKERS = 4
+
+
+class PooledClient:
+    def __init__(self, chat):
+        self.chat = chat
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+
+class GigaChatPool:
+    """
+    Общий для всех сессий и перезапусков скрипта пул клиентов GigaChat.
+    Ключ — (base_url, model, хеш данных авторизации): пользователи с одинаковыми
+    настройками делят один HTTP-пул, токен обновляется заранее, простаивающие
+    клиенты закрываются фоновым потоком.
+    """
+
+    def __init__(self, idle_ttl=CLIENT_IDLE_TTL, refresh_margin=TOKEN_REFRESH_MARGIN, max_clients=MAX_POOLED_CLIENTS):
+        self.idle_ttl = idle_ttl
+        self.refresh_margin = refresh_margin
+        self.max_clients = max_clients
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = threading.Thread(target=self._sweep_forever, daemon=True)
+        self._sweeper.start()
+
+    @staticmethod
+    def identity(**auth):
+        """Хеш данных авторизации, чтобы секреты не хранились в ключах пула"""
+        raw = "\x00".join(f"{name}={auth[name] or ''}" for name in sorted(auth))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _create(self, base_url, model, auth):
+        return GigaChat(
+            base_url=base_url,
+            model=model,
+            scope="GIGACHAT_API_PERS",
+            verify_ssl_certs=False,
+            **auth,
+        )
+
+    def _close(self, entry):
+        try:
+            entry.chat._client.close()
+        except Exception:
+            pass
+
+    def evict_idle(self):
+        """Закрывает клиенты, которые не использовались дольше idle_ttl"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items()
+                       if not entry.in_use and now - entry.last_used > self.idle_ttl]
+            evicted = [self._entries.pop(key) for key in expired]
+        for entry in evicted:
+            self._close(entry)
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(min(self.idle_ttl, 60))
+            self.evict_idle()
+
+    def _refresh_token(self, entry):
+        """Получает новый токен, если до истечения текущего осталось меньше refresh_margin"""
+        client = entry.chat._client
+        if not getattr(client, "_use_auth", False):
+            return  # передан готовый access token, обновлять нечем
+
+        def expiring():
+            token = getattr(client, "_access_token", None)
+            return token is None or token.expires_at / 1000 - time.time() < self.refresh_margin
+
+        if expiring():
+            # Старый токен не сбрасываем: другие сессии могут прямо сейчас
+            # отправлять с ним запросы, get_token сам заменит его новым
+            with entry.lock:
+                if expiring():
+                    client.get_token()
+
+    @contextmanager
+    def lease(self, base_url, model, **auth):
+        """Выдаёт клиент из пула; пока он выдан, вытеснять его нельзя"""
+        key = (base_url, model, self.identity(**auth))
+        overflow = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = PooledClient(self._create(base_url, model, auth))
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry.in_use += 1
+            if len(self._entries) > self.max_clients:
+                for old_key, old in list(self._entries.items()):
+                    if len(self._entries) <= self.max_clients:
+                        break
+                    if not old.in_use:
+                        overflow.append(self._entries.pop(old_key))
+        for old in overflow:
+            self._close(old)
+        try:
+            self._refresh_token(entry)
+            yield entry.chat
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+
+class ImageCache:
+    """
+    Дисковый кэш сгенерированных изображений с вытеснением по LRU.
+    Файлы лежат под именем sha256 содержимого, image_uuid → хеш хранится
+    в index.json, так что одинаковые картинки не дублируются, а в истории
+    чата остаётся только путь к файлу.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._uuids = self._load_index()
+        # Файлы в порядке последнего обращения: имя → размер
+        self._files = OrderedDict()
+        entries = [entry for entry in os.scandir(directory)
+                   if entry.is_file() and entry.name != "index.json" and not entry.name.endswith(".tmp")]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self._files[entry.name] = entry.stat().st_size
+        self._size = sum(self._files.values())
+        self._uuids = {uuid: name for uuid, name in self._uuids.items() if name in self._files}
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._uuids, f)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _extension(data):
+        if data.startswith(b"\x89PNG"):
+            return ".png"
+        if data.startswith(b"\xff\xd8"):
+            return ".jpg"
+        return ".img"
+
+    def lookup(self, image_uuid):
+        """Путь к изображению, если оно уже в кэше"""
+        with self._lock:
+            name = self._uuids.get(image_uuid)
+            if name is None:
+                return None
+            self._files.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, image_uuid, data):
+        """Сохраняет байты изображения и возвращает путь к файлу"""
+        name = hashlib.sha256(data).hexdigest() + self._extension(data)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if name not in self._files:
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._files[name] = len(data)
+                self._size += len(data)
+            self._files.move_to_end(name)
+            self._uuids[image_uuid] = name
+            self._evict()
+            self._save_index()
+        return path
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self._uuids = {uuid: n for uuid, n in self._uuids.items() if n != name}
+
+    def fetch(self, image_uuid, client):
+        """Возвращает путь к изображению, при промахе скачивает его через client.get_file"""
+        path = self.lookup(image_uuid)
+        if path is not None:
+            return path
+        data = base64.b64decode(client.get_file(image_uuid).content)
+        return self.put(image_uuid, data)
+
+
+@st.cache_resource
+def get_client_pool():
+    return GigaChatPool()
+
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
+
+
+@st.cache_resource
+def get_image_fetcher():
+    return ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
+
+
+def render_parts(parts):
+    """Выводит сообщение ассистента: текст через markdown, изображения с диска"""
+    for part in parts:
+        if part["type"] == "text":
+            st.markdown(part["text"], True)
+        elif part.get("path") and os.path.exists(part["path"]):
+            st.image(part["path"], width=IMAGE_WIDTH)
+        elif part.get("path"):
+            st.caption("Изображение удалено из кэша")
+        else:
+            st.caption("Не удалось загрузить изображение")
+
+
+class StreamingPresenter:
+    """
+    Вывод ответа по мере генерации. Каждый фрагмент (абзацы текста, изображение)
+    получает свой st.empty, и перерисовывается только последний текстовый.
+    Текст копится и выводится кадрами — по времени или по объёму, а длинный
+    текст замораживается на границах абзацев, чтобы перерисовка не росла квадратично.
+    Изображения скачиваются в фоне, на их месте до готовности стоит заглушка.
+    """
+
+    def __init__(self, parts, client, frame_interval=FRAME_INTERVAL, frame_chars=FRAME_CHARS,
+                 segment_chars=SEGMENT_CHARS):
+        self.parts = parts
+        self.client = client
+        self.frame_interval = frame_interval
+        self.frame_chars = frame_chars
+        self.segment_chars = segment_chars
+        self.container = st.container()
+        self.slots = []
+        self.downloads = {}        # future → индекс фрагмента-изображения
+        self._dirty = 0            # символов, ещё не выведенных на экран
+        self._last_frame = 0.0
+
+    def _new_slot(self):
+        slot = self.container.empty()
+        self.slots.append(slot)
+        return slot
+
+    def add_text(self, text):
+        if not text:
+            return
+        if self.parts and self.parts[-1]["type"] == "text":
+            self.parts[-1]["text"] += text
+        else:
+            self.parts.append({"type": "text", "text": text})
+            self._new_slot()
+        self._dirty += len(text)
+        if self._dirty >= self.frame_chars or time.monotonic() - self._last_frame >= self.frame_interval:
+            self.flush(cursor=True)
+
+    def _split_segment(self):
+        """Отделяет от растущего текста готовые абзацы; вне блоков кода, чтобы не сломать разметку"""
+        part = self.parts[-1]
+        text = part["text"]
+        if len(text) < self.segment_chars:
+            return
+        cut = text.rfind("\n\n", self.segment_chars // 2)
+        if cut <= 0 or text[:cut].count("```") % 2:
+            return
+        part["text"] = text[:cut]
+        self.slots[-1].markdown(part["text"], True)
+        self.parts.append({"type": "text", "text": text[cut + 2:]})
+        self._new_slot()
+
+    def flush(self, cursor=False):
+        """Перерисовывает последний текстовый фрагмент"""
+        self._last_frame = time.monotonic()
+        self._dirty = 0
+        if not self.parts or self.parts[-1]["type"] != "text":
+            return
+        self._split_segment()
+        self.slots[-1].markdown(self.parts[-1]["text"] + ("▌" if cursor else ""), True)
+
+    def add_image(self, image_uuid):
+        self.flush()
+        self.parts.append({"type": "image", "path": None, "uuid": image_uuid})
+        self._new_slot().caption("Загрузка изображения…")
+        future = get_image_fetcher().submit(get_image_cache().fetch, image_uuid, self.client)
+        self.downloads[future] = len(self.parts) - 1
+
+    def _splice(self, future):
+        index = self.downloads.pop(future)
+        try:
+            self.parts[index]["path"] = future.result()
+            self.slots[index].image(self.parts[index]["path"], width=IMAGE_WIDTH)
+        except Exception:
+            self.slots[index].caption("Не удалось загрузить изображение")
+
+    def poll(self):
+        """Подставляет скачанные изображения; вызывается из основного потока скрипта"""
+        for future in [f for f in self.downloads if f.done()]:
+            self._splice(future)
+
+    def finish(self):
+        self.flush()
+        wait(list(self.downloads))
+        self.poll()
+
+
+def render_message(message):
+    with st.chat_message(message.role):
+        if message.role == "assistant":
+            render_parts(message.additional_kwargs["render_parts"])
+        else:
+            st.markdown(message.content, True)
+
 # Настройка заголовка приложения
 st.title("Чат-бот на GigaChat")
 
@@ -56,17 +408,23 @@ if "messages" not in st.session_state:
         ChatMessage(
             role="assistant",
             content="Здравствуйте! Я ваш ИИ-помощник. Чем могу помочь?",
-            additional_kwargs={"render_content": "Здравствуйте! Я ваш ИИ-помощник. Чем могу помочь?"},
+            additional_kwargs={"render_parts": [{"type": "text", "text": "Здравствуйте! Я ваш ИИ-помощник. Чем могу помочь?"}]},
         ),
     ]
 
-# Отображение истории сообщений
-for message in st.session_state.messages:
-    with st.chat_message(message.role):
-        if message.role == "assistant":
-            st.markdown(message.additional_kwargs["render_content"], True)
-        else:
-            st.markdown(message.content, True)
+# Отображение истории: последние сообщения целиком, более ранние — свёрнутыми страницами,
+# которые отрисовываются, только если их открыть
+visible_messages = [message for message in st.session_state.messages if message.role != "system"]
+older_messages = visible_messages[:-HISTORY_RECENT_MESSAGES]
+if older_messages:
+    with st.expander(f"Ранние сообщения ({len(older_messages)})"):
+        for start in range(0, len(older_messages), HISTORY_PAGE_SIZE):
+            page = older_messages[start:start + HISTORY_PAGE_SIZE]
+            if st.checkbox(f"Сообщения {start + 1}–{start + len(page)}", key=f"history_page_{start}"):
+                for message in page:
+                    render_message(message)
+for message in visible_messages[-HISTORY_RECENT_MESSAGES:]:
+    render_message(message)
 
 # Обработка ввода пользователя
 if user_input := st.chat_input("Введите ваше сообщение..."):
@@ -75,17 +433,13 @@ if user_input := st.chat_input("Введите ваше сообщение..."):
         st.warning("Для работы чата необходимо указать данные авторизации")
         st.stop()
 
-    # Инициализация модели GigaChat
-    chat = GigaChat(
-        base_url=base_url,
-        credentials=credentials if auth_method == "По credentials" else None,
-        model=model,
-        access_token=st.session_state.get("token") or locals().get('access_token'),
-        user=user if auth_method == "По логину/паролю" else None,
-        password=password if auth_method == "По логину/паролю" else None,
-        scope="GIGACHAT_API_PERS",
-        verify_ssl_certs=False,
-    ).bind_tools(tools=[], tool_choice="auto")
+    # Данные авторизации выбранного способа
+    if auth_method == "По credentials":
+        auth = {"credentials": credentials}
+    elif auth_method == "По токену":
+        auth = {"access_token": access_token}
+    else:
+        auth = {"user": user, "password": password}
 
     # Добавление сообщения пользователя в историю
     user_message = ChatMessage(role="user", content=user_input)
@@ -99,16 +453,18 @@ if user_input := st.chat_input("Введите ваше сообщение..."):
     assistant_message = ChatMessage(
         role="assistant", 
         content="", 
-        additional_kwargs={"render_content": ""}
+        additional_kwargs={"render_parts": []}
     )
     st.session_state.messages.append(assistant_message)
 
-    # Генерация и потоковый вывод ответа
-    with st.chat_message(assistant_message.role):
-        message_area = st.empty()
+    # Генерация и потоковый вывод ответа на клиенте из общего пула
+    with get_client_pool().lease(base_url, model, **auth) as llm, st.chat_message(assistant_message.role):
+        chat = llm.bind_tools(tools=[], tool_choice="auto")
+        presenter = StreamingPresenter(assistant_message.additional_kwargs["render_parts"], llm)
         loading_indicator = None
         
         for response_chunk in chat.stream(st.session_state.messages):
+            presenter.poll()
             if response_chunk.type == "FunctionInProgressMessage":
                 if not loading_indicator:
                     loading_indicator = st.spinner(text="Обработка...")
@@ -119,26 +475,17 @@ if user_input := st.chat_input("Введите ваше сообщение..."):
                     loading_indicator.__exit__(None, None, None)
                     loading_indicator = None
                 
-                # Обработка контента
-                if response_chunk.additional_kwargs.get("image_uuid"):
-                    image_data = chat.get_file(response_chunk.additional_kwargs["image_uuid"]).content
-                    assistant_message.additional_kwargs["render_content"] += f"""<img src="data:png;base64,{image_data}" style="width: 450px; display: block; border-radius: 10px;">"""
+                # Обработка контента: изображение скачивается в фоне, текст выводится кадрами
+                image_uuid = response_chunk.additional_kwargs.get("image_uuid")
+                if image_uuid:
+                    presenter.add_image(image_uuid)
                 else:
-                    assistant_message.additional_kwargs["render_content"] += response_chunk.content
+                    presenter.add_text(response_chunk.content)
                 
                 assistant_message.content += response_chunk.content
                 assistant_message.additional_kwargs = {
                     **assistant_message.additional_kwargs,
                     **response_chunk.additional_kwargs,
                 }
-
-                message_area.markdown(
-                    assistant_message.additional_kwargs["render_content"] + "▌", 
-                    True
-                )
         
-        message_area.markdown(assistant_message.additional_kwargs["render_content"], True)
-
-    # Сохранение токена для последующих запросов
-    st.session_state.token = chat._client.token
-    chat._client.close()
\ No newline at end of file
+        presenter.finish()
\ No newline at end of file
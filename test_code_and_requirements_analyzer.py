@@ -0,0 +1,222 @@
+"""Тесты загрузки страниц Confluence и учета разделов code_and_requirements_analyzer на локальной заглушке"""
+
+import asyncio
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("aiogram")
+pytest.importorskip("langchain_gigachat")
+pytest.importorskip("_config")
+
+# Хранилище сессий и разделов создается при импорте модуля - не трогаем рабочую базу
+os.environ.setdefault("ANALYZER_SESSIONS_DB", ":memory:")
+
+import code_and_requirements_analyzer as analyzer
+
+PAGE_BODY = "<h1>Цели</h1><p>Система принимает заявки круглосуточно.</p>"
+PAGES = {
+    "123": {"id": 123, "title": "Требования", "version": {"number": 7}, "body": {"storage": {"value": PAGE_BODY}}},
+}
+
+
+class ConfluenceStub(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        self.server.requests.append((parts.path, parse_qs(parts.query), self.headers.get("Authorization")))
+        if parts.path.startswith("/wiki/rest/api/content/"):
+            page = PAGES.get(parts.path.rsplit("/", 1)[1])
+            if page is None:
+                self.send_error(404)
+                return
+            payload = page
+        elif parts.path == "/wiki/rest/api/content":
+            query = parse_qs(parts.query)
+            title = query.get("title", [""])[0]
+            payload = {"results": [page for page in PAGES.values() if page["title"] == title]}
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ConfluenceStub)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def fetch(url, token="secret"):
+    """Загружает одну страницу новым клиентом и закрывает его сессию"""
+    async def wrapper():
+        client = analyzer.ConfluenceClient(token=token)
+        try:
+            return await client.fetch_page(url)
+        finally:
+            await client.close()
+    return asyncio.run(wrapper())
+
+
+def test_find_confluence_links_only_configured_host():
+    text = (
+        "Смотри https://wiki.example.ru/spaces/DEV/pages/123/Spec, "
+        "https://evil.example.com/spaces/DEV/pages/123/Spec и https://wiki.example.ru/about."
+    )
+    assert analyzer.find_confluence_links(text, "https://wiki.example.ru") == [
+        "https://wiki.example.ru/spaces/DEV/pages/123/Spec"
+    ]
+    assert analyzer.find_confluence_links(text, None) == []
+
+
+def test_fetch_page_by_id(server):
+    page = fetch(f"{base_url(server)}/wiki/spaces/DEV/pages/123/Trebovaniya")
+    assert page == {"id": "123", "title": "Требования", "version": 7, "body": PAGE_BODY}
+    path, query, auth = server.requests[-1]
+    assert path == "/wiki/rest/api/content/123"
+    assert query["expand"] == ["body.storage,version"]
+    assert auth == "Bearer secret"
+
+
+def test_fetch_page_by_page_id_query(server):
+    page = fetch(f"{base_url(server)}/wiki/pages/viewpage.action?pageId=123")
+    assert page["id"] == "123"
+    assert server.requests[-1][0] == "/wiki/rest/api/content/123"
+
+
+def test_fetch_page_by_space_and_title(server):
+    page = fetch(f"{base_url(server)}/wiki/display/DEV/%D0%A2%D1%80%D0%B5%D0%B1%D0%BE%D0%B2%D0%B0%D0%BD%D0%B8%D1%8F")
+    assert page["title"] == "Требования"
+    path, query, _ = server.requests[-1]
+    assert path == "/wiki/rest/api/content"
+    assert query["spaceKey"] == ["DEV"]
+    assert query["title"] == ["Требования"]
+
+
+def test_fetch_page_missing(server):
+    with pytest.raises(LookupError):
+        fetch(f"{base_url(server)}/wiki/display/DEV/Nope")
+
+
+def test_split_sections_keys_and_hashes():
+    markup = (
+        "<p>Вступление</p>"
+        "<h1>Цели</h1><p>Первая цель</p>"
+        "<h2>Детали</h2><p>Подробности</p>"
+        "<h2>Детали</h2><p>Еще подробности</p>"
+        "<h1>Сроки</h1><p>Квартал</p>"
+    )
+    sections = analyzer.split_sections(markup)
+    assert [s["key"] for s in sections] == [
+        "Введение", "Цели", "Цели / Детали", "Цели / Детали #2", "Сроки"
+    ]
+    assert sections[2]["text"] == "Подробности"
+
+    # Пробелы не меняют хеш, правка соседнего раздела не меняет ключи и хеши остальных
+    reformatted = analyzer.split_sections(markup.replace("<p>Первая цель</p>", "<p>Первая   цель\n</p>"))
+    assert [s["hash"] for s in reformatted] == [s["hash"] for s in sections]
+    edited = analyzer.split_sections(markup.replace("Квартал", "Полугодие"))
+    assert [s["hash"] for s in edited[:4]] == [s["hash"] for s in sections[:4]]
+    assert edited[4]["hash"] != sections[4]["hash"]
+
+
+def section(title, text):
+    return f"<h1>{title}</h1><p>{text}</p>"
+
+
+LONG = "Система должна обрабатывать не менее ста заявок в минуту"
+
+
+class FakeConfluence:
+    def __init__(self):
+        self.body = ""
+
+    async def fetch_pages(self, urls):
+        return [{"id": "42", "title": "Спецификация", "version": 1, "body": self.body} for _ in urls]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Подменяет загрузку страниц и модель; анализ раздела возвращает его текст"""
+    fake = FakeConfluence()
+    store = analyzer.SectionStore(":memory:")
+    calls = []
+    failing = set()
+
+    async def analyze_section(page, sec, instructions, semaphore):
+        calls.append(sec["key"])
+        if sec["key"] in failing:
+            raise RuntimeError("модель недоступна")
+        return f"замечания: {sec['text']}"
+
+    monkeypatch.setattr(analyzer, "confluence", fake)
+    monkeypatch.setattr(analyzer, "section_store", store)
+    monkeypatch.setattr(analyzer, "analyze_section", analyze_section)
+
+    def run(body):
+        fake.body = body
+        calls.clear()
+        report = asyncio.run(analyzer.analyze_confluence_pages(["https://wiki.example.ru/pages/viewpage.action?pageId=42"], ""))
+        return report, list(calls)
+
+    yield run, store, failing
+    store.close()
+
+
+def test_only_changed_sections_are_analyzed(pipeline):
+    run, store, _ = pipeline
+    body = section("А", LONG) + section("Б", LONG + " 2") + section("В", LONG + " 3")
+    _, calls = run(body)
+    assert sorted(calls) == ["А", "Б", "В"]
+    assert set(store.load("42")) == {"А", "Б", "В"}
+
+    report, calls = run(body)
+    assert calls == []
+    assert "изменено разделов 0 из 4" in report
+
+    # Б изменен, В сократился до пустяка, А удален
+    report, calls = run(section("Б", LONG + " изменено") + section("В", "мало"))
+    assert calls == ["Б"]
+    stored = store.load("42")
+    assert set(stored) == {"Б"}
+    assert stored["Б"][1] == f"замечания: {LONG} изменено"
+    assert "🗑 Удаленные разделы: А" in report
+    assert "\n✏️ Б\n" in report
+
+
+def test_failed_section_is_retried(pipeline):
+    run, store, failing = pipeline
+    body = section("А", LONG) + section("Б", LONG + " 2")
+    failing.add("Б")
+    report, calls = run(body)
+    assert sorted(calls) == ["А", "Б"]
+    assert set(store.load("42")) == {"А"}
+    assert "⚠️ Б" in report
+    assert "\n✏️ А\n" in report
+
+    failing.clear()
+    report, calls = run(body)
+    assert calls == ["Б"]
+    assert set(store.load("42")) == {"А", "Б"}
+    assert "⚠️" not in report
@@ -0,0 +1,143 @@
+"""Тесты загрузки и ранжирования страниц google_search_assistant на локальном HTTP-сервере"""
+
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("gigachat")
+pytest.importorskip("googlesearch")
+
+import google_search_assistant as gsa
+
+ARTICLE = """<html><head><title>Тестовая страница</title>
+<script>var tracking = "скрипт не должен попасть в текст страницы";</script>
+<style>body { color: red; }</style></head>
+<body>
+<nav><p>Главная страница раздел меню навигации сайта</p></nav>
+<header><p>Шапка сайта с логотипом и ссылками на разделы</p></header>
+<p>Космический телескоп Джеймс Уэбб наблюдает далёкие галактики в инфракрасном диапазоне.</p>
+<p>Рецепт борща требует свёклы, капусты, картофеля и говяжьего бульона.</p>
+<footer><p>Все права защищены авторами этого сайта навсегда</p></footer>
+</body></html>"""
+
+RELEVANT = "<html><body>" + "".join(
+    f"<p>Телескоп Уэбб получил новые снимки галактики номер {i} в инфракрасном свете.</p>" for i in range(5)
+) + "</body></html>"
+
+IRRELEVANT = "<html><body>" + "".join(
+    f"<p>Садовые работы осенью включают обрезку кустов и уборку листьев участок {i}.</p>" for i in range(5)
+) + "</body></html>"
+
+LONG_PAGE = "<html><body>" + "".join(
+    f"<p>Абзац номер {i} длинной страницы с достаточным количеством слов.</p>" for i in range(5000)
+) + "</body></html>"
+
+PAGES = {
+    "/article": ARTICLE,
+    "/relevant": RELEVANT,
+    "/irrelevant": IRRELEVANT,
+    "/long": LONG_PAGE,
+}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def run(coroutine):
+    """Запускает корутину в новом цикле и закрывает общий HTTP-клиент, привязанный к нему"""
+    async def wrapper():
+        try:
+            return await coroutine
+        finally:
+            if gsa._http_client is not None:
+                await gsa._http_client.aclose()
+                gsa._http_client = None
+    return asyncio.run(wrapper())
+
+
+def test_fetch_page_skips_scripts_and_navigation(server):
+    url, title, paragraphs = run(gsa.fetch_page(f"{server}/article", asyncio.Semaphore(1)))
+    text = " ".join(paragraphs)
+    assert url == f"{server}/article"
+    assert title == "Тестовая страница"
+    assert "Джеймс Уэбб" in text
+    assert "борща" in text
+    for skipped in ("скрипт", "color", "навигации", "логотипом", "права защищены"):
+        assert skipped not in text
+
+
+def test_fetch_page_stops_after_max_page_chars(server, monkeypatch):
+    monkeypatch.setattr(gsa, "MAX_PAGE_CHARS", 20_000)
+    _, _, paragraphs = run(gsa.fetch_page(f"{server}/long", asyncio.Semaphore(1)))
+    assert paragraphs
+    assert len(paragraphs) < 5000
+    assert "Абзац номер 4999" not in " ".join(paragraphs)
+
+
+def test_bm25_rank_orders_by_score():
+    ranked = gsa.bm25_rank("телескоп Уэбб галактики", ["уборка листьев осенью", "телескоп Уэбб снимки галактики"])
+    assert [index for index, _ in ranked] == [1, 0]
+    assert ranked[0][1] > 0
+    assert ranked[1][1] == 0
+
+
+def test_fetch_and_rank_prefers_relevant_passages(server):
+    urls = [f"{server}/irrelevant", f"{server}/relevant"]
+    results = run(gsa.fetch_and_rank("телескоп Уэбб галактики", urls, budget=10_000))
+    by_url = {item["url"]: item for item in results}
+    assert [item["url"] for item in results] == urls
+    assert by_url[f"{server}/relevant"]["snippets"]
+    assert all("Телескоп" in snippet for snippet in by_url[f"{server}/relevant"]["snippets"])
+    # Даже при большом бюджете фрагменты без слов из запроса не попадают в контекст
+    assert by_url[f"{server}/irrelevant"]["snippets"] == []
+
+
+def test_fetch_and_rank_respects_token_budget(server):
+    urls = [f"{server}/relevant", f"{server}/irrelevant"]
+    budget = 60
+    results = run(gsa.fetch_and_rank("телескоп Уэбб галактики", urls, budget=budget))
+    snippets = [snippet for item in results for snippet in item["snippets"]]
+    assert snippets
+    assert sum(gsa.estimate_tokens(snippet) for snippet in snippets) <= budget
+    full = run(gsa.fetch_and_rank("телескоп Уэбб галактики", urls, budget=10_000))
+    assert full[1]["snippets"] == []
+    assert len(snippets) < sum(len(item["snippets"]) for item in full)
+
+
+def test_failed_fetches_are_not_cached(server, monkeypatch):
+    monkeypatch.setattr(gsa, "search_google", lambda query: [f"{server}/missing"])
+    monkeypatch.setattr(gsa, "search_cache", gsa.TTLCache(60, 10))
+    result = run(gsa.google_search_handler("нет такой страницы"))
+    assert result[0]["error"]
+    assert gsa.search_cache.get(gsa.normalize_query("нет такой страницы")) is None
+
+    monkeypatch.setattr(gsa, "search_google", lambda query: [f"{server}/relevant"])
+    result = run(gsa.google_search_handler("телескоп"))
+    assert gsa.search_cache.get(gsa.normalize_query("телескоп")) == result